@@ -0,0 +1,111 @@
+import os
+import time
+import asyncio
+from typing import List, Optional
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Query
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from app.helpers.openaiApi import retrieve_and_generate_async
+from app.helpers.jobs import enqueue_job, enqueue_document_job, get_job, cancel_job, ensure_worker, init_jobs_table
+from app.helpers.db import init_database, select_documents
+from app.helpers.metrics import metrics, prometheus_text
+
+# Ingestion runs in a separate worker process (python -m app.worker) fed by the ingest_jobs table;
+# set START_INGEST_WORKER=0 when workers are managed externally
+START_INGEST_WORKER = os.getenv("START_INGEST_WORKER", "1") == "1"
+
+
+class Question(BaseModel):
+    question: str
+    # Restrict retrieval to these documents; all documents when omitted
+    doc_ids: Optional[List[str]] = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await asyncio.to_thread(init_database)
+    await asyncio.to_thread(init_jobs_table)
+    if START_INGEST_WORKER:
+        await asyncio.to_thread(ensure_worker)
+    yield
+
+
+app = FastAPI(title="Layout Aware RAG", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    t0 = time.perf_counter()
+    response = await call_next(request)
+    # Route template ("/jobs/{job_id}"), not the raw path, keeps the label set bounded
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    metrics.observe("http.request", time.perf_counter() - t0, method=request.method, route=route)
+    metrics.increment("http.responses", route=route, status=response.status_code)
+    return response
+
+
+@app.post("/ask/rag_response")
+async def rag_response(question: Question):
+    answer, pages, ai_chunks = await retrieve_and_generate_async(question.question, question.doc_ids)
+    return {"answer": answer, "pages": pages, "ai_chunks": ai_chunks.to_dict(orient="list")}
+
+
+@app.post("/ingest")
+async def ingest(file: UploadFile = File(...), incremental: bool = True, doc_id: Optional[str] = None):
+    pdf_bytes = await file.read()
+    job_id = await asyncio.to_thread(enqueue_job, pdf_bytes, file.filename, incremental, doc_id)
+    if START_INGEST_WORKER:
+        await asyncio.to_thread(ensure_worker)
+    return await asyncio.to_thread(get_job, job_id)
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await asyncio.to_thread(get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def job_cancel(job_id: str):
+    if await asyncio.to_thread(get_job, job_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    await asyncio.to_thread(cancel_job, job_id)
+    return await asyncio.to_thread(get_job, job_id)
+
+
+@app.get("/documents")
+async def documents():
+    return await asyncio.to_thread(select_documents)
+
+
+@app.delete("/documents/{doc_id}")
+async def delete_document(doc_id: str):
+    """Queue the removal of a document; the worker deletes it once no other job on it is running."""
+    job_id = await asyncio.to_thread(enqueue_document_job, doc_id, "delete")
+    if START_INGEST_WORKER:
+        await asyncio.to_thread(ensure_worker)
+    return await asyncio.to_thread(get_job, job_id)
+
+
+@app.post("/documents/{doc_id}/deferred")
+async def read_deferred_regions(doc_id: str, pages: Optional[List[int]] = Query(None)):
+    """Queue a read of the regions the region policy deferred (all pages, or ?pages=3&pages=4).
+
+    The worker OCRs them and re-indexes those pages; poll the returned job, whose progress ends as {"regions": n}.
+    """
+    job_id = await asyncio.to_thread(enqueue_document_job, doc_id, "deferred", pages)
+    if START_INGEST_WORKER:
+        await asyncio.to_thread(ensure_worker)
+    return await asyncio.to_thread(get_job, job_id)
+
+
+@app.get("/metrics")
+async def metrics_endpoint(format: str = "json"):
+    """Counters and timers of this API process; ingestion metrics live in the worker (METRICS_PORT)."""
+    if format == "prometheus":
+        return PlainTextResponse(prometheus_text())
+    return metrics.snapshot()
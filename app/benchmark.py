@@ -0,0 +1,258 @@
+"""Retrieval quality and latency benchmark: python -m app.benchmark questions.json [--stub] [--output results.json]
+
+The question set is a JSON list (or a CSV with the same columns, as used by the evaluation notebooks):
+    [{"question": "...", "ground_truth_ids": ["report/page_3.md_chunk2", ...], "doc_ids": ["report"]}, ...]
+doc_ids is optional. Questions run against the corpus already ingested in application.db.
+
+With --stub, the OpenAI APIs are served by app.stub_openai and the chunks are re-embedded into a
+separate numpy index (data/benchmark_index), so runs are offline and deterministic. Results
+(precision/recall/MRR and p50/p95 latency per stage) are written as JSON; --baseline compares
+against an earlier results file and exits non-zero on regressions.
+"""
+import os
+import sys
+import json
+import math
+import time
+import sqlite3
+import argparse
+import subprocess
+from datetime import datetime
+
+BENCHMARK_INDEX_PATH = os.path.join("data", "benchmark_index")
+STUB_EMBEDDING_MODEL = "stub-embedding"
+STUB_CHAT_MODEL = "stub-chat"
+STAGES = ["embedding", "retrieval", "generation", "highlighting"]
+QUALITY_METRICS = ["precision", "recall", "mrr"]
+
+
+def load_questions(path):
+    if path.endswith(".csv"):
+        import ast
+        import pandas as pd
+        questions = pd.read_csv(path).to_dict(orient="records")
+        for item in questions:
+            for key in ("ground_truth_ids", "doc_ids"):
+                if isinstance(item.get(key), str):
+                    item[key] = ast.literal_eval(item[key])
+                elif key in item and not isinstance(item[key], list):
+                    item[key] = None
+        return questions
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+def latency_summary(seconds):
+    ms = [s * 1000 for s in seconds]
+    return {
+        "count": len(ms),
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "mean_ms": sum(ms) / len(ms) if ms else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def use_stub_openai():
+    """Route OpenAI calls to an in-process stub server. Must run before app.helpers modules are imported."""
+    from app.stub_openai import start_stub_server
+    server, base_url = start_stub_server()
+    os.environ.update({
+        "OPENAI_BASE_URL": base_url,
+        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY") or "stub",
+        "EMBEDDING_MODEL": STUB_EMBEDDING_MODEL,
+        "CHAT_MODEL": STUB_CHAT_MODEL,
+        "VECTOR_BACKEND": "numpy",
+        "NUMPY_INDEX_PATH": BENCHMARK_INDEX_PATH,
+    })
+    return server
+
+
+def build_benchmark_index(reindex=False):
+    """Embed every chunk of the corpus into the (stub) vector store; returns the number of vectors."""
+    from app.helpers.db import DATABASE_PATH
+    from app.helpers.embeddings import embed_texts
+    from app.helpers.vector_store import get_vector_store
+
+    store = get_vector_store()
+    if store.count() and not reindex:
+        return store.count()
+    store.reset()
+    with sqlite3.connect(DATABASE_PATH) as conn:
+        rows = conn.execute("SELECT id, text FROM chunks ORDER BY id").fetchall()
+    chunked_documents = [{"id": chunk_id, "text": text} for chunk_id, text in rows]
+    for doc, embedding in zip(chunked_documents, embed_texts([doc["text"] for doc in chunked_documents])):
+        doc["embedding"] = embedding
+    store.upsert(chunked_documents)
+    return len(chunked_documents)
+
+
+def run_question(item, args):
+    from app.helpers import openaiApi
+    from app.helpers.documents import chunk_source_key
+    from app.helpers.query_cache import normalize_question
+
+    question, doc_ids = item["question"], item.get("doc_ids") or None
+    ground_truth_ids = item.get("ground_truth_ids") or []
+    timings = {}
+
+    # Stages are timed separately and bypass the query/answer caches
+    embedding = None
+    if args.mode != "lexical":
+        t0 = time.perf_counter()
+        embedding = openaiApi.embed_text(normalize_question(question))
+        timings["embedding"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    chunks, retrieved_ids = openaiApi.search_documents(question, embedding, args.n_results, doc_ids, args.mode)
+    timings["retrieval"] = time.perf_counter() - t0
+
+    pages = []
+    if not args.skip_generation:
+        extracted_citations = [chunk_source_key(chunk_id) for chunk_id in retrieved_ids]
+        formatted_chunks = openaiApi.format_chunks(chunks, retrieved_ids)
+        t0 = time.perf_counter()
+        answer = openaiApi.generate_response(question, formatted_chunks, extracted_citations).replace("_", " ")
+        timings["generation"] = time.perf_counter() - t0
+        pages, ai_chunks = openaiApi.source_pages(answer, chunks, retrieved_ids, extracted_citations)
+
+        if args.highlight and pages:
+            from app.tabs.chatbot import annotate_source_page
+            t0 = time.perf_counter()
+            for source in pages:
+                annotate_source_page({}, source, ai_chunks)
+            timings["highlighting"] = time.perf_counter() - t0
+
+    precision, recall = openaiApi.compute_precision_recall(retrieved_ids, ground_truth_ids)
+    return {
+        "question": question,
+        "doc_ids": doc_ids,
+        "retrieved_ids": retrieved_ids,
+        "ground_truth_ids": ground_truth_ids,
+        "cited_pages": pages,
+        "precision": precision,
+        "recall": recall,
+        "mrr": openaiApi.compute_mrr(retrieved_ids, ground_truth_ids),
+        "seconds": timings,
+    }
+
+
+def run_benchmark(questions, args):
+    from app.helpers import openaiApi
+    from app.helpers.chunking import CHUNKER, CHUNK_MAX_TOKENS
+    from app.helpers.vector_store import VECTOR_BACKEND
+
+    corpus_vectors = build_benchmark_index(args.reindex) if args.stub else None
+    per_question, samples = [], {stage: [] for stage in STAGES + ["total"]}
+    for repeat in range(args.repeat):
+        for item in questions:
+            result = run_question(item, args)
+            for stage, seconds in result["seconds"].items():
+                samples[stage].append(seconds)
+            samples["total"].append(sum(result["seconds"].values()))
+            if repeat == 0:
+                per_question.append(result)
+                print(f"🧪 P={result['precision']:.2f} R={result['recall']:.2f} MRR={result['mrr']:.2f} "
+                      f"{sum(result['seconds'].values()) * 1000:.0f}ms  {result['question'][:60]}")
+
+    n = max(len(per_question), 1)
+    return {
+        "config": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "questions_file": args.questions,
+            "stub": args.stub,
+            "retrieval_mode": args.mode,
+            "n_results": args.n_results,
+            "repeat": args.repeat,
+            "chunker": CHUNKER,
+            "chunk_max_tokens": CHUNK_MAX_TOKENS,
+            "vector_backend": VECTOR_BACKEND,
+            "hybrid_candidates": openaiApi.HYBRID_CANDIDATES,
+            "hybrid_lexical_weight": openaiApi.HYBRID_LEXICAL_WEIGHT,
+            "embedding_model": openaiApi.EMBEDDING_MODEL,
+            "chat_model": openaiApi.CHAT_MODEL,
+            "corpus_vectors": corpus_vectors,
+        },
+        "summary": {
+            **{metric: sum(r[metric] for r in per_question) / n for metric in QUALITY_METRICS},
+            "questions": len(per_question),
+            "latency": {stage: latency_summary(values) for stage, values in samples.items() if values},
+        },
+        "questions": per_question,
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance, latency_tolerance=None):
+    """Print metric deltas against a baseline run; returns the list of regressions."""
+    regressions = []
+    for metric in QUALITY_METRICS:
+        current, previous = results["summary"][metric], baseline["summary"][metric]
+        print(f"📊 {metric}: {previous:.3f} -> {current:.3f} ({current - previous:+.3f})")
+        if current < previous - tolerance:
+            regressions.append(metric)
+    for stage, latency in results["summary"]["latency"].items():
+        previous = baseline["summary"]["latency"].get(stage)
+        if not previous or not previous["p95_ms"]:
+            continue
+        change = latency["p95_ms"] / previous["p95_ms"] - 1
+        print(f"⏱️ {stage} p95: {previous['p95_ms']:.1f}ms -> {latency['p95_ms']:.1f}ms ({change:+.0%})")
+        if latency_tolerance is not None and change > latency_tolerance:
+            regressions.append(f"{stage}_p95")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval quality and latency on a labeled question set.")
+    parser.add_argument("questions", help="JSON or CSV file of questions with ground_truth_ids")
+    parser.add_argument("--output", default=os.path.join("benchmark_results", "results.json"))
+    parser.add_argument("--stub", action="store_true", help="offline: stub OpenAI server and a stub-embedded index")
+    parser.add_argument("--reindex", action="store_true", help="re-embed the corpus into the stub index")
+    parser.add_argument("--mode", choices=["hybrid", "vector", "lexical"], default=os.getenv("RETRIEVAL_MODE", "hybrid"))
+    parser.add_argument("--n-results", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=1, help="runs per question for latency percentiles")
+    parser.add_argument("--skip-generation", action="store_true")
+    parser.add_argument("--highlight", action="store_true", help="also time source page highlighting")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="allowed drop in precision/recall/MRR")
+    parser.add_argument("--latency-tolerance", type=float, help="allowed relative p95 increase, e.g. 0.2")
+    args = parser.parse_args()
+
+    if args.stub:
+        use_stub_openai()
+    results = run_benchmark(load_questions(args.questions), args)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    summary = results["summary"]
+    print(f"✅ {summary['questions']} questions: precision {summary['precision']:.3f}, recall {summary['recall']:.3f}, "
+          f"MRR {summary['mrr']:.3f} -> {args.output}")
+    for stage, latency in summary["latency"].items():
+        print(f"⏱️ {stage}: p50 {latency['p50_ms']:.1f}ms, p95 {latency['p95_ms']:.1f}ms")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance, args.latency_tolerance)
+        if regressions:
+            print(f"❌ Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
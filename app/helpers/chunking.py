@@ -0,0 +1,168 @@
+import os
+
+from app.helpers.documents import DEFAULT_DOCUMENT, make_chunk_id
+
+# "layout" packs whole Surya blocks under a token budget; "fixed" is the 1000-character splitter
+CHUNKER = os.getenv("CHUNKER", "layout")
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", 400))
+# Blocks with these labels always open a new chunk
+SECTION_LABELS = ("sectionheader", "title")
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text
+    return max(1, len(text) // 4)
+
+
+def is_content_label(label):
+    """Whether a region's text belongs in the page text that gets chunked and embedded.
+
+    Tables count: deferred ones have no text until ocr_deferred_regions() reads them.
+    """
+    label = label.lower()
+    return all(x not in label for x in ["figure", "pagefooter", "picture", "pageheader"])
+
+
+def page_text(text_blocks):
+    return "".join(f"{obj.text}\n" for obj in text_blocks if is_content_label(obj.label))
+
+
+def block_spans(text_blocks):
+    """(block_index, start, end) character offsets of each content block within page_text()."""
+    spans, offset = [], 0
+    for obj in text_blocks:
+        if not is_content_label(obj.label):
+            continue
+        end = offset + len(obj.text) + 1
+        spans.append((obj.block_index, offset, end))
+        offset = end
+    return spans
+
+
+def split_text(text, chunk_size=1000, chunk_overlap=20):
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        chunks.append(text[start:end])
+        start = end - chunk_overlap
+
+    return chunks
+
+
+def chunk_page(page_number, text_blocks, chunk_size=1000, chunk_overlap=20, doc_id=DEFAULT_DOCUMENT):
+    """Split a page's text into fixed-size chunks, recording the layout blocks each chunk covers."""
+    spans = block_spans(text_blocks)
+    chunks = []
+    for i, chunk in enumerate(split_text(page_text(text_blocks), chunk_size, chunk_overlap)):
+        start = i * (chunk_size - chunk_overlap)
+        end = start + len(chunk)
+        chunks.append({
+            "id": make_chunk_id(doc_id, page_number, i + 1),
+            "text": chunk,
+            "doc_id": doc_id,
+            "page": f"page_{page_number}",
+            # Block spans clipped to the chunk, relative to the chunk text
+            "blocks": [(b, max(s, start) - start, min(e, end) - start) for b, s, e in spans if s < end and e > start],
+        })
+    return chunks
+
+
+def split_label(label):
+    """'SectionHeader-3-0.97' -> ('SectionHeader', 3, 0.97)"""
+    name, position, confidence = label.rsplit("-", 2)
+    return name, int(position), float(confidence)
+
+
+def reading_order(text_blocks):
+    def position(obj):
+        try:
+            return split_label(obj.label)[1]
+        except ValueError:
+            return obj.block_index
+    return sorted(text_blocks, key=position)
+
+
+def split_block_text(text, max_tokens, first_tokens=None):
+    """Split an oversized block on word boundaries into pieces of roughly max_tokens.
+
+    The first piece gets first_tokens instead, e.g. what is left of the chunk it will join.
+    """
+    pieces, start = [], 0
+    max_chars = (first_tokens or max_tokens) * 4
+    while start < len(text):
+        end = min(len(text), start + max_chars)
+        if end < len(text):
+            space = text.rfind(" ", start, end)
+            if space > start:
+                end = space + 1
+        piece = text[start:end].strip()
+        if piece:
+            pieces.append(piece)
+        start = end
+        max_chars = max_tokens * 4
+    return pieces
+
+
+def chunk_page_layout(page_number, text_blocks, max_tokens=CHUNK_MAX_TOKENS, doc_id=DEFAULT_DOCUMENT):
+    """Pack a page's content blocks, in reading order, into chunks of at most max_tokens.
+
+    Blocks are never cut unless a single block exceeds the budget; such a block first fills what
+    is left of the current chunk. Section headers start a new chunk and always stay with the block
+    after them, even if that takes the chunk slightly over budget. Each chunk keeps the block
+    indices and offsets it was built from.
+    """
+    chunks, parts, tokens = [], [], 0
+    # parts holds nothing but section headers, which must not become a chunk of their own
+    headers_only = False
+
+    def flush():
+        texts, blocks, offset = [], [], 0
+        for obj, piece in parts:
+            blocks.append((obj.block_index, offset, offset + len(piece)))
+            texts.append(piece)
+            offset += len(piece) + 1
+        chunks.append({
+            "id": make_chunk_id(doc_id, page_number, len(chunks) + 1),
+            "text": "\n".join(texts),
+            "doc_id": doc_id,
+            "page": f"page_{page_number}",
+            "blocks": blocks,
+        })
+        parts.clear()
+
+    for obj in reading_order([b for b in text_blocks if is_content_label(b.label)]):
+        text = obj.text.strip()
+        if not text:
+            continue
+        is_section = obj.label.rsplit("-", 2)[0].lower() in SECTION_LABELS
+        was_headers_only = headers_only
+        if parts and is_section and not headers_only:
+            flush()
+            tokens = 0
+        if estimate_tokens(text) <= max_tokens:
+            pieces = [text]
+        else:
+            if parts and tokens >= max_tokens:
+                flush()
+                tokens = 0
+            pieces = split_block_text(text, max_tokens, first_tokens=max_tokens - tokens)
+        for piece in pieces:
+            piece_tokens = estimate_tokens(piece)
+            if parts and not headers_only and tokens + piece_tokens > max_tokens:
+                flush()
+                tokens = 0
+            parts.append((obj, piece))
+            tokens += piece_tokens
+            headers_only = False
+        headers_only = is_section and (was_headers_only or len(parts) == 1)
+    if parts:
+        flush()
+    return chunks
+
+
+def build_chunks(page):
+    """Chunks of a document_model.Page with the configured CHUNKER."""
+    if CHUNKER == "fixed":
+        return chunk_page(page.number, page.blocks, doc_id=page.doc_id)
+    return chunk_page_layout(page.number, page.blocks, doc_id=page.doc_id)
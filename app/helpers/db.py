@@ -3,8 +3,28 @@ import json
 import pandas as pd
 from datetime import datetime
 
+from app.helpers.documents import DEFAULT_DOCUMENT
+from app.helpers.document_model import Block, Page
+
 DATABASE_PATH = "application.db"
 
+# WAL lets the chat tab read while ingestion writes; NORMAL sync is safe under WAL and skips per-commit fsyncs
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA busy_timeout=10000",
+)
+
+
+def connect(db_path=DATABASE_PATH):
+    """Open a SQLite connection tuned for bulk ingest writes."""
+    conn = sqlite3.connect(db_path, timeout=10)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
 
 def init_database():
     """Create necessary tables if they don't exist."""
@@ -26,7 +46,51 @@ def init_database():
                 text TEXT,
                 label TEXT,
                 page TEXT,
-                poly TEXT
+                poly TEXT,
+                block_index INTEGER,
+                doc_id TEXT,
+                source TEXT,
+                words TEXT
+            )
+        ''')
+        # Tables created before block_index / doc_id / source / words existed
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(layout_analysis)')]
+        if "block_index" not in columns:
+            cursor.execute('ALTER TABLE layout_analysis ADD COLUMN block_index INTEGER')
+        if "doc_id" not in columns:
+            cursor.execute('ALTER TABLE layout_analysis ADD COLUMN doc_id TEXT')
+        if "source" not in columns:
+            cursor.execute('ALTER TABLE layout_analysis ADD COLUMN source TEXT')
+        if "words" not in columns:
+            cursor.execute('ALTER TABLE layout_analysis ADD COLUMN words TEXT')
+        cursor.execute('DROP INDEX IF EXISTS idx_layout_analysis_page')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_layout_analysis_doc_page ON layout_analysis (doc_id, page, block_index)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS collection_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        # Fingerprints from before multi-document support can't be attributed to a document
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(page_fingerprints)')]
+        if columns and "doc_id" not in columns:
+            cursor.execute('DROP TABLE page_fingerprints')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS page_fingerprints (
+                doc_id TEXT,
+                page TEXT,
+                fingerprint TEXT,
+                pipeline_version TEXT,
+                PRIMARY KEY (doc_id, page)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_id TEXT PRIMARY KEY,
+                filename TEXT,
+                pdf_path TEXT,
+                page_count INTEGER,
+                ingested_at TEXT
             )
         ''')
         conn.commit()
@@ -54,25 +118,93 @@ def select_messages():
     return messages
 
 
-def select_layout_analysis(page_label: str) -> pd.DataFrame:
-    """Return layout analysis results for a given page label (e.g., 'page_1')."""
+def select_layout_analysis(page_label: str, doc_id: str = DEFAULT_DOCUMENT) -> pd.DataFrame:
+    """Return layout analysis results for a given page label (e.g., 'page_1') of a document."""
     with sqlite3.connect(DATABASE_PATH) as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM layout_analysis WHERE page = ?', (page_label,))
+        cursor.execute('SELECT id, text, label, page, poly FROM layout_analysis WHERE doc_id = ? AND page = ?',
+                       (doc_id, page_label))
         rows = cursor.fetchall()
     return pd.DataFrame(rows, columns=["id", "text", "label", "page", "poly"])
 
 
-def insert_layout_analysis(data):
-    """Insert a list of layout analysis entries (dicts with text, label, page, poly)."""
+def select_chunk_polys(chunk_ids):
+    """Return the decoded polygons of the layout blocks covered by the given chunks, in reading order."""
+    if not chunk_ids:
+        return []
+    placeholders = ",".join("?" * len(chunk_ids))
+    with sqlite3.connect(DATABASE_PATH) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT DISTINCT la.doc_id, la.page, la.block_index, la.poly
+            FROM chunk_blocks cb
+            JOIN layout_analysis la
+                ON la.doc_id = cb.doc_id AND la.page = cb.page AND la.block_index = cb.block_index
+            WHERE cb.chunk_id IN ({placeholders})
+            ORDER BY la.doc_id, la.page, la.block_index
+        ''', list(chunk_ids))
+        rows = cursor.fetchall()
+    return [json.loads(poly) for *_, poly in rows]
+
+
+def insert_layout_analysis(pages, conn=None):
+    """Insert the blocks of document_model.Page objects; words (OCR word boxes) are stored as JSON.
+
+    Pass an open connection to batch the insert into the caller's transaction.
+    """
+    rows = [
+        (block.text, block.label, page.label, json.dumps(block.poly), block.block_index, page.doc_id, block.source,
+         None if block.words is None else json.dumps(block.words))
+        for page in pages
+        for block in page.blocks
+    ]
+    if conn is not None:
+        conn.executemany('''
+            INSERT INTO layout_analysis (text, label, page, poly, block_index, doc_id, source, words)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        return
+    with connect() as conn:
+        insert_layout_analysis(pages, conn)
+        conn.commit()
+
+
+def select_pages(doc_id=DEFAULT_DOCUMENT, page_labels=None):
+    """A document's stored layout analysis as document_model.Page objects, in page and region order."""
+    query = 'SELECT page, text, label, poly, block_index, source, words FROM layout_analysis WHERE doc_id = ?'
+    params = [doc_id]
+    if page_labels is not None:
+        query += f" AND page IN ({','.join('?' * len(page_labels))})"
+        params += list(page_labels)
+    with sqlite3.connect(DATABASE_PATH) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query + " ORDER BY CAST(substr(page, 6) AS INTEGER), block_index", params)
+        rows = cursor.fetchall()
+    pages = {}
+    for page, text, label, poly, block_index, source, words in rows:
+        number = int(page.split("_")[1])
+        pages.setdefault(number, Page(number, doc_id=doc_id)).blocks.append(
+            Block(text, label, json.loads(poly), block_index, source, None if words is None else json.loads(words)))
+    return list(pages.values())
+
+
+def select_deferred_regions(doc_id=DEFAULT_DOCUMENT, page_labels=None):
+    """(id, page, poly, label) of a document's regions the region policy deferred, optionally for some pages."""
+    query = "SELECT id, page, poly, label FROM layout_analysis WHERE doc_id = ? AND source = 'deferred'"
+    params = [doc_id]
+    if page_labels is not None:
+        query += f" AND page IN ({','.join('?' * len(page_labels))})"
+        params += list(page_labels)
     with sqlite3.connect(DATABASE_PATH) as conn:
         cursor = conn.cursor()
-        for item in data:
-            if "text" in item and "label" in item and "page" in item and "poly" in item:
-                cursor.execute('''
-                    INSERT INTO layout_analysis (text, label, page, poly)
-                    VALUES (?, ?, ?, ?)
-                ''', (item['text'], item['label'], item['page'], json.dumps(item['poly'])))
+        cursor.execute(query + " ORDER BY CAST(substr(page, 6) AS INTEGER), block_index", params)
+        return cursor.fetchall()
+
+
+def update_layout_analysis_texts(rows):
+    """Set text, source and words (JSON or None) of layout analysis rows from (text, source, words, id) tuples."""
+    with connect() as conn:
+        conn.executemany('UPDATE layout_analysis SET text = ?, source = ?, words = ? WHERE id = ?', rows)
         conn.commit()
 
 
@@ -82,3 +214,101 @@ def reset_layout_analysis_table():
         cursor.execute("DROP TABLE IF EXISTS layout_analysis")
         conn.commit()
     init_database()
+
+
+def delete_layout_analysis_pages(page_labels, doc_id=DEFAULT_DOCUMENT):
+    """Delete a document's layout analysis rows for the given page labels, or all of them when page_labels is None."""
+    with connect() as conn:
+        cursor = conn.cursor()
+        if page_labels is None:
+            cursor.execute('DELETE FROM layout_analysis WHERE doc_id = ?', (doc_id,))
+        else:
+            cursor.executemany('DELETE FROM layout_analysis WHERE doc_id = ? AND page = ?',
+                               [(doc_id, p) for p in page_labels])
+        conn.commit()
+
+
+def select_page_fingerprints(doc_id=DEFAULT_DOCUMENT) -> dict:
+    """Return {page_label: fingerprint} for every ingested page of a document."""
+    with sqlite3.connect(DATABASE_PATH) as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT page, fingerprint FROM page_fingerprints WHERE doc_id = ?', (doc_id,))
+        rows = cursor.fetchall()
+    return dict(rows)
+
+
+def upsert_page_fingerprints(fingerprints, pipeline_version, doc_id=DEFAULT_DOCUMENT):
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT OR REPLACE INTO page_fingerprints (doc_id, page, fingerprint, pipeline_version)
+            VALUES (?, ?, ?, ?)
+        ''', [(doc_id, page, fp, pipeline_version) for page, fp in fingerprints.items()])
+        conn.commit()
+
+
+def delete_page_fingerprints(page_labels=None, doc_id=DEFAULT_DOCUMENT):
+    """Delete a document's fingerprints for the given pages, or all of them when page_labels is None."""
+    with connect() as conn:
+        cursor = conn.cursor()
+        if page_labels is None:
+            cursor.execute('DELETE FROM page_fingerprints WHERE doc_id = ?', (doc_id,))
+        else:
+            cursor.executemany('DELETE FROM page_fingerprints WHERE doc_id = ? AND page = ?',
+                               [(doc_id, p) for p in page_labels])
+        conn.commit()
+
+
+def upsert_document(doc_id, filename, pdf_path, page_count):
+    with connect() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO documents (doc_id, filename, pdf_path, page_count, ingested_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (doc_id, filename, pdf_path, page_count, datetime.now().isoformat(timespec="seconds")))
+        conn.commit()
+
+
+def select_documents():
+    """Every ingested document as a dict, in upload order."""
+    with sqlite3.connect(DATABASE_PATH) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT doc_id, filename, pdf_path, page_count, ingested_at FROM documents ORDER BY ingested_at')
+        except sqlite3.OperationalError:
+            return []
+        rows = cursor.fetchall()
+    return [dict(zip(["doc_id", "filename", "pdf_path", "page_count", "ingested_at"], row)) for row in rows]
+
+
+def delete_document_row(doc_id):
+    with connect() as conn:
+        conn.execute('DELETE FROM documents WHERE doc_id = ?', (doc_id,))
+        conn.commit()
+
+
+def get_collection_version() -> int:
+    """Counter bumped whenever the indexed chunks change; used to invalidate query caches."""
+    with sqlite3.connect(DATABASE_PATH) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT value FROM collection_state WHERE key = 'version'")
+        except sqlite3.OperationalError:
+            return 0
+        row = cursor.fetchone()
+    return int(row[0]) if row else 0
+
+
+def bump_collection_version():
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS collection_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        cursor.execute('''
+            INSERT INTO collection_state (key, value) VALUES ('version', '1')
+            ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        ''')
+        conn.commit()
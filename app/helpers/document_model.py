@@ -0,0 +1,49 @@
+from array import array
+
+from app.helpers.documents import DEFAULT_DOCUMENT
+
+# In-memory pages handed from layout/OCR straight to chunking, embedding and SQLite, without a disk round trip.
+# __slots__ and flat float arrays keep thousands of blocks cheap compared with dicts of nested point lists.
+
+
+class Block:
+    """One Surya region of a page: its text, label ("Text-3-0.97") and polygon."""
+    __slots__ = ("text", "label", "coords", "block_index", "source", "words")
+
+    def __init__(self, text, label, poly, block_index, source="ocr", words=None):
+        self.text = text
+        self.label = label
+        # x0, y0, x1, y1, ... in page pixels
+        self.coords = array("d", [v for point in poly for v in point])
+        self.block_index = block_index
+        # "ocr", "text_layer" or "deferred"
+        self.source = source
+        # OCR word boxes [word, confidence, [left, top, right, bottom]], None when unavailable
+        self.words = words
+
+    @property
+    def poly(self):
+        return [[x, y] for x, y in zip(self.coords[::2], self.coords[1::2])]
+
+    def __repr__(self):
+        return f"Block({self.block_index}, {self.label!r}, {self.source}, {len(self.text)} chars)"
+
+
+class Page:
+    """A document page and its blocks in region order."""
+    __slots__ = ("number", "blocks", "doc_id")
+
+    def __init__(self, number, blocks=(), doc_id=DEFAULT_DOCUMENT):
+        self.number = number
+        self.blocks = list(blocks)
+        self.doc_id = doc_id
+
+    @property
+    def label(self):
+        return f"page_{self.number}"
+
+    def count(self, source):
+        return sum(1 for block in self.blocks if block.source == source)
+
+    def __repr__(self):
+        return f"Page({self.doc_id!r}, {self.number}, {len(self.blocks)} blocks)"
@@ -0,0 +1,51 @@
+import os
+import re
+
+# Identifiers for a multi-document corpus.
+#   doc_id:     slug of the uploaded file name ("Annual Report 2023.pdf" -> "annual-report-2023")
+#   chunk id:   "<doc_id>/page_<n>.md_chunk<k>"
+#   source key: "<doc_id>/page_<n>", one page of one document
+# doc_ids never contain "_", "/" or ".", so all three split unambiguously.
+
+DEFAULT_DOCUMENT = "uploaded"
+DOCUMENTS_DIR = os.path.join("data", "documents")
+
+
+def document_id(filename):
+    stem = os.path.splitext(os.path.basename(filename or ""))[0]
+    slug = re.sub(r"[^a-z0-9]+", "-", stem.lower()).strip("-")
+    return slug or DEFAULT_DOCUMENT
+
+
+def document_pdf_path(doc_id):
+    return os.path.join(DOCUMENTS_DIR, f"{doc_id}.pdf")
+
+
+def document_text_dir(doc_id):
+    """base_dir (under data/) of a document's page markdown and region crops."""
+    return os.path.join("text_data", doc_id)
+
+
+def source_key(doc_id, page_number):
+    return f"{doc_id}/page_{page_number}"
+
+
+def make_chunk_id(doc_id, page_number, chunk_number):
+    return f"{source_key(doc_id, page_number)}.md_chunk{chunk_number}"
+
+
+def chunk_source_key(chunk_id):
+    # "report/page_3.md_chunk2" -> "report/page_3"
+    return chunk_id.split(".")[0]
+
+
+def parse_source_key(key):
+    """'report/page_3' -> ('report', 3); keys without a document belong to DEFAULT_DOCUMENT."""
+    doc_id, _, page_label = key.rpartition("/")
+    return doc_id or DEFAULT_DOCUMENT, int(page_label.split("_")[1])
+
+
+def citation_label(key):
+    # How a source is cited in prompts and answers: "report page 3"
+    doc_id, page_number = parse_source_key(key)
+    return f"{doc_id} page {page_number}"
@@ -0,0 +1,126 @@
+import os
+import time
+import hashlib
+from array import array
+
+from app.helpers.db import DATABASE_PATH, connect
+
+# Size-bounded: least recently used vectors are evicted once the cache exceeds this many bytes
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# SQLite host-parameter limit is 999 on older builds
+LOOKUP_BATCH = 500
+
+cache_stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+_initialized = set()
+
+
+def init_embedding_cache(db_path=DATABASE_PATH):
+    """Create the embedding cache table if it doesn't exist."""
+    with connect(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                embedding BLOB,
+                nbytes INTEGER,
+                last_used REAL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used ON embedding_cache (last_used)')
+        conn.commit()
+    _initialized.add(db_path)
+
+
+def _connect(db_path):
+    if db_path not in _initialized:
+        init_embedding_cache(db_path)
+    return connect(db_path)
+
+
+def chunk_key(text, model):
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def encode_embedding(embedding):
+    return array("f", embedding).tobytes()
+
+
+def decode_embedding(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+def get_cached_embeddings(texts, model, db_path=DATABASE_PATH):
+    """Return a list aligned with texts holding cached embeddings, or None for misses."""
+    keys = [chunk_key(text, model) for text in texts]
+    found = {}
+    unique_keys = list(dict.fromkeys(keys))
+    with _connect(db_path) as conn:
+        cursor = conn.cursor()
+        for i in range(0, len(unique_keys), LOOKUP_BATCH):
+            batch = unique_keys[i:i + LOOKUP_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            cursor.execute(f'SELECT key, embedding FROM embedding_cache WHERE key IN ({placeholders})', batch)
+            found.update({key: decode_embedding(blob) for key, blob in cursor.fetchall()})
+        if found:
+            now = time.time()
+            cursor.executemany('UPDATE embedding_cache SET last_used = ? WHERE key = ?',
+                               [(now, key) for key in found])
+        conn.commit()
+
+    results = [found.get(key) for key in keys]
+    hits = sum(1 for r in results if r is not None)
+    cache_stats["hits"] += hits
+    cache_stats["misses"] += len(results) - hits
+    return results
+
+
+def put_cached_embeddings(texts, embeddings, model, db_path=DATABASE_PATH, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+    now = time.time()
+    rows = []
+    for text, embedding in zip(texts, embeddings):
+        blob = encode_embedding(embedding)
+        rows.append((chunk_key(text, model), model, blob, len(blob), now))
+    with _connect(db_path) as conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO embedding_cache (key, model, embedding, nbytes, last_used)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+    cache_stats["writes"] += len(rows)
+    evict_embedding_cache(max_bytes, db_path)
+
+
+def evict_embedding_cache(max_bytes=EMBEDDING_CACHE_MAX_BYTES, db_path=DATABASE_PATH):
+    """Drop least recently used entries until the cache fits in max_bytes."""
+    with _connect(db_path) as conn:
+        cursor = conn.cursor()
+        total = cursor.execute('SELECT COALESCE(SUM(nbytes), 0) FROM embedding_cache').fetchone()[0]
+        if total <= max_bytes:
+            return 0
+        to_free, stale = total - max_bytes, []
+        for key, nbytes in cursor.execute('SELECT key, nbytes FROM embedding_cache ORDER BY last_used ASC'):
+            if to_free <= 0:
+                break
+            stale.append((key,))
+            to_free -= nbytes
+        cursor.executemany('DELETE FROM embedding_cache WHERE key = ?', stale)
+        conn.commit()
+    cache_stats["evictions"] += len(stale)
+    return len(stale)
+
+
+def embedding_cache_stats(db_path=DATABASE_PATH):
+    with _connect(db_path) as conn:
+        entries, size = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM embedding_cache'
+        ).fetchone()
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    return {
+        **cache_stats,
+        "entries": entries,
+        "bytes": size,
+        "hit_rate": cache_stats["hits"] / lookups if lookups else 0.0,
+    }
@@ -1,126 +1,198 @@
 import os
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import chromadb
-from openai import OpenAI
-from chromadb.utils import embedding_functions
-import streamlit as st
-import shutil
+from openai import OpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from app.helpers.db import connect, bump_collection_version, select_pages
+from app.helpers.chunking import build_chunks, estimate_tokens
+from app.helpers.embedding_cache import get_cached_embeddings, put_cached_embeddings, embedding_cache_stats
+from app.helpers.vector_store import get_vector_store
+from app.helpers.documents import DEFAULT_DOCUMENT
+from app.helpers.lexical_index import ensure_lexical_index, drop_lexical_index, delete_lexical_chunks, index_chunks
+from app.helpers.metrics import metrics, span, record_usage
 
 # Load environment
 load_dotenv()
 openai_key = os.getenv("OPENAI_API_KEY")
 
-import sqlite3
+# Also the embedding cache key: vectors from different models (or a stub server) never mix
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+# Request packing: each embeddings.create call carries at most this many inputs / estimated tokens
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", 30000))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_MAX_WORKERS = int(os.getenv("EMBEDDING_MAX_WORKERS", 4))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", 6))
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
 
-def save_chunks_to_sqlite(chunked_documents, db_path="application.db"):
+def save_chunks_to_sqlite(chunked_documents, db_path="application.db", replace_pages=None, doc_id=None):
+    """Store chunk texts, their chunk -> layout block mapping and the lexical (FTS5) index.
+
+    With replace_pages, only those pages of doc_id are replaced; with doc_id alone, all of that
+    document's chunks are; with neither, both tables are rebuilt from scratch.
+    """
     # Connect to SQLite DB (creates it if it doesn't exist)
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
     cursor = conn.cursor()
-    
-    # Create table (drop first if it exists to avoid duplicates)
-    cursor.execute("DROP TABLE IF EXISTS chunks")
+
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(chunks)")]
+    if (replace_pages is None and doc_id is None) or (columns and "doc_id" not in columns):
+        # Full rebuild (or tables from before multi-document support): drop first to avoid duplicates
+        cursor.execute("DROP TABLE IF EXISTS chunks")
+        cursor.execute("DROP TABLE IF EXISTS chunk_blocks")
+        drop_lexical_index(cursor)
     cursor.execute("""
-        CREATE TABLE chunks (
+        CREATE TABLE IF NOT EXISTS chunks (
             id TEXT PRIMARY KEY,
-            text TEXT
+            text TEXT,
+            doc_id TEXT,
+            page TEXT
+        )
+    """)
+    # Chunk -> layout block mapping with each block's character span in the page text
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chunk_blocks (
+            chunk_id TEXT,
+            doc_id TEXT,
+            page TEXT,
+            block_index INTEGER,
+            block_start INTEGER,
+            block_end INTEGER
         )
     """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunks_doc_page ON chunks (doc_id, page)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunk_blocks_chunk_id ON chunk_blocks (chunk_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunk_blocks_doc_page ON chunk_blocks (doc_id, page)")
+    ensure_lexical_index(cursor)
+    if doc_id is not None and replace_pages is None:
+        cursor.execute("DELETE FROM chunks WHERE doc_id = ?", (doc_id,))
+        cursor.execute("DELETE FROM chunk_blocks WHERE doc_id = ?", (doc_id,))
+        delete_lexical_chunks(cursor, doc_id)
+    elif replace_pages:
+        # Incremental: only the chunks of re-analyzed or removed pages are replaced
+        doc_id = doc_id or DEFAULT_DOCUMENT
+        cursor.executemany("DELETE FROM chunks WHERE doc_id = ? AND page = ?", [(doc_id, page) for page in replace_pages])
+        cursor.executemany("DELETE FROM chunk_blocks WHERE doc_id = ? AND page = ?", [(doc_id, page) for page in replace_pages])
+        delete_lexical_chunks(cursor, doc_id, replace_pages)
     
     # Insert all chunked documents
     cursor.executemany(
-        "INSERT INTO chunks (id, text) VALUES (?, ?)",
-        [(doc["id"], doc["text"]) for doc in chunked_documents]
+        "INSERT OR REPLACE INTO chunks (id, text, doc_id, page) VALUES (?, ?, ?, ?)",
+        [(doc["id"], doc["text"], doc.get("doc_id", DEFAULT_DOCUMENT), doc.get("page")) for doc in chunked_documents]
+    )
+    cursor.executemany(
+        "INSERT INTO chunk_blocks (chunk_id, doc_id, page, block_index, block_start, block_end) VALUES (?, ?, ?, ?, ?, ?)",
+        [(doc["id"], doc.get("doc_id", DEFAULT_DOCUMENT), doc["page"], *block)
+         for doc in chunked_documents for block in doc.get("blocks", [])]
     )
+    index_chunks(cursor, chunked_documents)
     
     conn.commit()
     conn.close()
     print(f"✅ Saved {len(chunked_documents)} chunks to '{db_path}' in table 'chunks'")
 
-def clear_chroma_folders(chroma_dir="data/chroma_persistent_storage"):
-    chroma_dir = os.path.join("data", "chroma_persistent_storage")
-    for item in os.listdir(chroma_dir):
-        item_path = os.path.join(chroma_dir, item)
-        # Delete folders only, keep files (like chroma.sqlite3)
-        if os.path.isdir(item_path):
-            shutil.rmtree(item_path)
-
-# Load documents from directory
-def load_documents_from_directory(directory_path):
-    documents = []
-    for filename in os.listdir(directory_path):
-        if filename.endswith(".md"):
-            with open(os.path.join(directory_path, filename), "r", encoding="utf-8") as file:
-                documents.append({"id": filename, "text": file.read()})
-    return documents
-
-def split_text(text, chunk_size=1000, chunk_overlap=20):
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = start + chunk_size
-        chunks.append(text[start:end])
-        start = end - chunk_overlap
-    
-    return chunks
+def get_openai_client():
+    # OPENAI_BASE_URL points the client at a local stub server for offline runs
+    return OpenAI(api_key=openai_key, base_url=os.getenv("OPENAI_BASE_URL") or None)
 
 # This function now receives the OpenAI client
 def get_openai_embedding(text, openai_client):
-    response = openai_client.embeddings.create(input=text, model="text-embedding-3-small")
+    response = openai_client.embeddings.create(input=text, model=EMBEDDING_MODEL)
+    record_usage("embeddings", response.usage)
     embedding = response.data[0].embedding
     return embedding
 
-def spilt_docs():
-    directory_path = os.path.join("data", "text_data", "all_pages")
-    if not os.path.exists(directory_path):
-        raise FileNotFoundError(f"❌ Directory '{directory_path}' not found. Run layout analysis first.")
+def make_embedding_batches(texts, max_tokens=EMBEDDING_BATCH_TOKENS, max_inputs=EMBEDDING_BATCH_SIZE):
+    """Pack texts into (start_index, texts) batches bounded by token budget and input count."""
+    batches = []
+    start, current, current_tokens = 0, [], 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_inputs):
+            batches.append((start, current))
+            start, current, current_tokens = i, [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        batches.append((start, current))
+    return batches
+
+def embed_batch(texts, openai_client, model=EMBEDDING_MODEL, max_retries=EMBEDDING_MAX_RETRIES):
+    """Embed a list of texts in one request, retrying with exponential backoff on throttling."""
+    for attempt in range(max_retries + 1):
+        try:
+            with span("openai.embeddings", inputs=len(texts), attempt=attempt):
+                response = openai_client.embeddings.create(input=texts, model=model)
+            record_usage("embeddings", response.usage)
+            return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+        except RETRYABLE_ERRORS as e:
+            metrics.increment("openai.retries", endpoint="embeddings", error=type(e).__name__)
+            if attempt == max_retries:
+                raise
+            wait = min(60, 2 ** attempt) + random.uniform(0, 1)
+            print(f"⚠️ Embedding request failed ({type(e).__name__}), retry {attempt + 1}/{max_retries} in {wait:.1f}s")
+            time.sleep(wait)
+
+def embed_texts(texts, openai_client=None, model=EMBEDDING_MODEL, max_workers=EMBEDDING_MAX_WORKERS):
+    """Embed texts with batched requests on a bounded thread pool; output keeps input order."""
+    openai_client = openai_client or get_openai_client()
+    batches = make_embedding_batches(texts)
+    embeddings = [None] * len(texts)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = {pool.submit(embed_batch, batch, openai_client, model): start for start, batch in batches}
+        for future, start in futures.items():
+            for offset, embedding in enumerate(future.result()):
+                embeddings[start + offset] = embedding
+    print(f"🧮 Embedded {len(texts)} chunks in {len(batches)} requests")
+    return embeddings
 
-    documents = load_documents_from_directory(directory_path)
-    print(f"📄 Loaded {len(documents)} pages")
-    # Split text into chunks
-    chunked_documents = []
-    for doc in documents:
-        chunks = split_text(doc['text'])
-        for i, chunk in enumerate(chunks):
-            chunked_documents.append({"id": f"{doc['id']}_chunk{i+1}", "text": chunk})
-            
-    save_chunks_to_sqlite(chunked_documents)
+def embed_texts_cached(texts, model=EMBEDDING_MODEL):
+    """Embed texts, reusing cached vectors for chunks already embedded with the same model."""
+    embeddings = get_cached_embeddings(texts, model)
+    missing = {}
+    for i, embedding in enumerate(embeddings):
+        if embedding is None:
+            missing.setdefault(texts[i], []).append(i)
+    if missing:
+        unique_texts = list(missing)
+        fresh = embed_texts(unique_texts, model=model)
+        put_cached_embeddings(unique_texts, fresh, model)
+        for text, embedding in zip(unique_texts, fresh):
+            for i in missing[text]:
+                embeddings[i] = embedding
+    reused = len(texts) - sum(len(v) for v in missing.values())
+    metrics.increment("embedding_cache.hits", reused)
+    metrics.increment("embedding_cache.misses", len(texts) - reused)
+    stats = embedding_cache_stats()
+    print(f"🗃️ Embedding cache: {reused}/{len(texts)} reused, "
+          f"{stats['entries']} entries, hit rate {stats['hit_rate']:.0%}")
+    return embeddings
+
+def spilt_docs(pages=None, doc_id=DEFAULT_DOCUMENT):
+    """Chunk a document's stored pages (all, or the given page labels) in page order and save the chunks."""
+    document_pages = select_pages(doc_id, pages)
+    if not document_pages:
+        raise FileNotFoundError(f"❌ No layout analysis stored for '{doc_id}'. Run layout analysis first.")
+    print(f"📄 Loaded {len(document_pages)} pages")
+    chunked_documents = [chunk for page in document_pages for chunk in build_chunks(page)]
+    save_chunks_to_sqlite(chunked_documents, replace_pages=pages, doc_id=doc_id)
     return chunked_documents
 
-def generate_embeddings():
-    openai_client = OpenAI(api_key=openai_key)
-    chunked_documents =  spilt_docs()
-    for doc in chunked_documents:
-        doc["embedding"] = get_openai_embedding(doc["text"], openai_client)
+def generate_embeddings(pages=None, doc_id=DEFAULT_DOCUMENT):
+    chunked_documents =  spilt_docs(pages, doc_id)
+    embeddings = embed_texts_cached([doc["text"] for doc in chunked_documents])
+    for doc, embedding in zip(chunked_documents, embeddings):
+        doc["embedding"] = embedding
         
     return chunked_documents
 
-def insert_embeddings_into_vector_db(chunked_documents):
-    # Initialize consistent Chroma and OpenAI clients
-    chroma_client = chromadb.PersistentClient(path="./data/chroma_persistent_storage")
-    collection_name = "document_qa_collection"
-    clear_chroma_folders()
-    # Delete old collection (if it exists)
-    try:
-        chroma_client.delete_collection(name=collection_name)
-        print("✅ Deleted previous collection.")
-    except Exception as e:
-        print(f"⚠️ Could not delete collection: {e}")
-
-    # Initialize embedding function for Chroma
-    openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-        api_key=openai_key,
-        model_name="text-embedding-3-small",
-    )
-
-    # Recreate collection with embedding function
-    collection = chroma_client.get_or_create_collection(
-        name=collection_name,
-        embedding_function=openai_ef
-    )
-    
-    for doc in chunked_documents:
-        collection.upsert(
-            ids=[doc["id"]],
-            documents=[doc["text"]],
-            embeddings=[doc["embedding"]]
-        )
\ No newline at end of file
+def insert_embeddings_into_vector_db(chunked_documents, replace_pages=None, doc_id=DEFAULT_DOCUMENT):
+    store = get_vector_store()
+    if replace_pages is None:
+        store.delete_document(doc_id)
+    elif replace_pages:
+        store.delete_pages(replace_pages, doc_id)
+        print(f"✅ Deleted vectors of {len(replace_pages)} changed pages.")
+    with span("ingest.upsert_vectors", doc_id=doc_id, chunks=len(chunked_documents)):
+        store.upsert(chunked_documents)
+    bump_collection_version()
@@ -0,0 +1,69 @@
+import os
+
+from app.helpers.layout_analysis import remove_page_files, remove_document_files
+from app.helpers.page_cache import page_cache
+from app.helpers.pipeline import run_ingest_pipeline
+from app.helpers.embeddings import save_chunks_to_sqlite
+from app.helpers.vector_store import get_vector_store
+from app.helpers.documents import DEFAULT_DOCUMENT, DOCUMENTS_DIR, document_pdf_path, document_text_dir
+from app.helpers.db import (
+    init_database, delete_layout_analysis_pages, select_page_fingerprints, delete_page_fingerprints,
+    bump_collection_version, upsert_document, delete_document_row,
+)
+
+
+def clear_document(doc_id):
+    """Remove every trace of one document: files, layout rows, chunks, vectors and fingerprints."""
+    remove_document_files(doc_id)
+    delete_layout_analysis_pages(None, doc_id)
+    save_chunks_to_sqlite([], doc_id=doc_id)
+    get_vector_store().delete_document(doc_id)
+    delete_page_fingerprints(None, doc_id)
+    bump_collection_version()
+
+
+def remove_document(doc_id):
+    init_database()
+    clear_document(doc_id)
+    delete_document_row(doc_id)
+
+
+def ingest_document(pdf_file, incremental=True, on_progress=None, should_stop=None,
+                    doc_id=DEFAULT_DOCUMENT, filename=None):
+    """Ingest one PDF (upload or bytes) as document doc_id: full rebuild, or only changed pages when incremental.
+
+    Other documents in the corpus are left untouched. Returns the pipeline's per-stage page
+    counts plus the number of removed pages.
+    """
+    init_database()
+    page_count = page_cache.page_count(pdf_file)
+    previous_fingerprints = select_page_fingerprints(doc_id) if incremental else {}
+
+    if not previous_fingerprints:
+        clear_document(doc_id)
+
+    os.makedirs(DOCUMENTS_DIR, exist_ok=True)
+    save_path = document_pdf_path(doc_id)
+    with open(save_path, "wb") as f:
+        f.write(pdf_file if isinstance(pdf_file, (bytes, bytearray)) else pdf_file.getvalue())
+    upsert_document(doc_id, filename or getattr(pdf_file, "name", f"{doc_id}.pdf"), save_path, page_count)
+
+    progress = run_ingest_pipeline(pdf_file, page_count, previous_fingerprints,
+                                   on_progress=on_progress, should_stop=should_stop, doc_id=doc_id)
+
+    removed_pages = [p for p in previous_fingerprints if int(p.split("_")[1]) > page_count]
+    if removed_pages:
+        for page_label in removed_pages:
+            remove_page_files(int(page_label.split("_")[1]), document_text_dir(doc_id))
+        delete_layout_analysis_pages(removed_pages, doc_id)
+        save_chunks_to_sqlite([], replace_pages=removed_pages, doc_id=doc_id)
+        get_vector_store().delete_pages(removed_pages, doc_id)
+        bump_collection_version()
+        delete_page_fingerprints(removed_pages, doc_id)
+
+    for label, timing in list(progress["ocr_timings"].items())[:5]:
+        print(f"🔠 OCR {label}: {timing['regions']} regions, {timing['total_seconds']:.1f}s total, "
+              f"{timing['mean_seconds']:.2f}s mean, {timing['max_seconds']:.2f}s max")
+    print(f"♻️ Ingest {doc_id}: {progress['upsert']} analyzed, {len(removed_pages)} removed, "
+          f"{progress['skipped']} unchanged")
+    return {**progress, "removed": len(removed_pages)}
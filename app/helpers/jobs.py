@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import subprocess
+
+from app.helpers.db import DATABASE_PATH, connect, select_deferred_regions
+from app.helpers.documents import document_id, parse_source_key
+
+# Uploaded PDFs of queued jobs live outside data/, which a full rebuild empties
+JOBS_DIR = os.getenv("INGEST_JOBS_DIR", "ingest_jobs")
+WORKER_PID_FILE = os.path.join(JOBS_DIR, "worker.pid")
+# Held (flock) by the running worker for its whole life: there is exactly one writer of the vector store
+WORKER_LOCK_FILE = os.path.join(JOBS_DIR, "worker.lock")
+ACTIVE_STATUSES = ("queued", "running")
+# "ingest" analyzes an uploaded PDF; "deferred" reads a document's deferred regions (all pages, or job["pages"])
+# and re-indexes those pages; "delete" removes a document. Every job that writes the indexes runs on the
+# worker, their single writer.
+JOB_KINDS = ("ingest", "deferred", "delete")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def init_jobs_table(db_path=DATABASE_PATH):
+    with connect(db_path) as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ingest_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT,
+                filename TEXT,
+                doc_id TEXT,
+                kind TEXT DEFAULT 'ingest',
+                pages TEXT,
+                pdf_path TEXT,
+                incremental INTEGER,
+                progress TEXT,
+                error TEXT,
+                cancel_requested INTEGER DEFAULT 0,
+                attempts INTEGER DEFAULT 0,
+                worker_pid INTEGER,
+                created_at REAL,
+                started_at REAL,
+                updated_at REAL,
+                finished_at REAL
+            )
+        ''')
+        # Tables created before multi-document support
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(ingest_jobs)')]
+        if "doc_id" not in columns:
+            conn.execute('ALTER TABLE ingest_jobs ADD COLUMN doc_id TEXT')
+        if "kind" not in columns:
+            conn.execute("ALTER TABLE ingest_jobs ADD COLUMN kind TEXT DEFAULT 'ingest'")
+            conn.execute('ALTER TABLE ingest_jobs ADD COLUMN pages TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs (status, created_at)')
+        conn.commit()
+
+
+def _row_to_job(cursor, row):
+    job = {col[0]: value for col, value in zip(cursor.description, row)}
+    job["progress"] = json.loads(job["progress"]) if job["progress"] else {}
+    job["pages"] = json.loads(job["pages"]) if job["pages"] else None
+    job["kind"] = job["kind"] or "ingest"
+    job["incremental"] = bool(job["incremental"])
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    return job
+
+
+def enqueue_job(pdf_bytes, filename="uploaded.pdf", incremental=True, doc_id=None):
+    """Queue one document for ingestion; doc_id defaults to a slug of the file name."""
+    init_jobs_table()
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    job_id = uuid.uuid4().hex
+    pdf_path = os.path.join(JOBS_DIR, f"{job_id}.pdf")
+    with open(pdf_path, "wb") as f:
+        f.write(pdf_bytes)
+    now = time.time()
+    with connect() as conn:
+        conn.execute('''
+            INSERT INTO ingest_jobs (id, status, filename, doc_id, pdf_path, incremental, created_at, updated_at)
+            VALUES (?, 'queued', ?, ?, ?, ?, ?, ?)
+        ''', (job_id, filename, doc_id or document_id(filename), pdf_path, int(incremental), now, now))
+        conn.commit()
+    return job_id
+
+
+def enqueue_document_job(doc_id, kind, pages=None):
+    """Queue a job of another kind (see JOB_KINDS) on an already ingested document."""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind {kind!r}, expected one of {JOB_KINDS}")
+    init_jobs_table()
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with connect() as conn:
+        conn.execute('''
+            INSERT INTO ingest_jobs (id, status, filename, doc_id, kind, pages, incremental, created_at, updated_at)
+            VALUES (?, 'queued', ?, ?, ?, ?, 0, ?, ?)
+        ''', (job_id, doc_id, doc_id, kind, None if pages is None else json.dumps(sorted(pages)), now, now))
+        conn.commit()
+    return job_id
+
+
+def queue_deferred_reads(source_keys):
+    """Queue deferred-region reads for the pages ("report/page_3") that still have deferred regions.
+
+    Pages already covered by a queued or running deferred job are left out. Returns the new job ids.
+    """
+    pages_by_doc = {}
+    for key in source_keys:
+        doc_id, page_number = parse_source_key(key)
+        pages_by_doc.setdefault(doc_id, set()).add(page_number)
+    for job in active_jobs():
+        if job["kind"] == "deferred" and job["doc_id"] in pages_by_doc:
+            pages_by_doc[job["doc_id"]] -= set(pages_by_doc[job["doc_id"]] if job["pages"] is None else job["pages"])
+    job_ids = []
+    for doc_id, pages in pages_by_doc.items():
+        if not pages:
+            continue
+        rows = select_deferred_regions(doc_id, [f"page_{n}" for n in pages])
+        if rows:
+            job_ids.append(enqueue_document_job(doc_id, "deferred", {int(page.split("_")[1]) for _, page, _, _ in rows}))
+    return job_ids
+
+
+def get_job(job_id):
+    init_jobs_table()
+    with connect() as conn:
+        cursor = conn.execute('SELECT * FROM ingest_jobs WHERE id = ?', (job_id,))
+        row = cursor.fetchone()
+        return _row_to_job(cursor, row) if row else None
+
+
+def active_jobs():
+    """Queued and running jobs, oldest first."""
+    init_jobs_table()
+    with connect() as conn:
+        cursor = conn.execute(f'''
+            SELECT * FROM ingest_jobs WHERE status IN ({",".join("?" * len(ACTIVE_STATUSES))})
+            ORDER BY created_at
+        ''', ACTIVE_STATUSES)
+        return [_row_to_job(cursor, row) for row in cursor.fetchall()]
+
+
+def claim_next_job(worker_pid):
+    """Atomically move the oldest queued job to running for this worker.
+
+    Jobs for a document that is already being ingested wait until that run finishes.
+    """
+    with connect() as conn:
+        conn.isolation_level = None
+        conn.execute('BEGIN IMMEDIATE')
+        cursor = conn.execute('''
+            SELECT * FROM ingest_jobs
+            WHERE status = 'queued'
+              AND (doc_id IS NULL OR doc_id NOT IN (
+                  SELECT doc_id FROM ingest_jobs WHERE status = 'running' AND doc_id IS NOT NULL))
+            ORDER BY created_at LIMIT 1
+        ''')
+        row = cursor.fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            return None
+        job = _row_to_job(cursor, row)
+        now = time.time()
+        conn.execute('''
+            UPDATE ingest_jobs SET status = 'running', worker_pid = ?, attempts = attempts + 1,
+                started_at = COALESCE(started_at, ?), updated_at = ?
+            WHERE id = ?
+        ''', (worker_pid, now, now, job["id"]))
+        conn.execute('COMMIT')
+    job["attempts"] += 1
+    job["status"] = "running"
+    return job
+
+
+def update_job_progress(job_id, progress):
+    with connect() as conn:
+        conn.execute('UPDATE ingest_jobs SET progress = ?, updated_at = ? WHERE id = ?',
+                     (json.dumps(progress), time.time(), job_id))
+        conn.commit()
+
+
+def finish_job(job_id, status, progress=None, error=None):
+    now = time.time()
+    with connect() as conn:
+        conn.execute('''
+            UPDATE ingest_jobs SET status = ?, progress = COALESCE(?, progress), error = ?,
+                finished_at = ?, updated_at = ?
+            WHERE id = ?
+        ''', (status, json.dumps(progress) if progress is not None else None, error, now, now, job_id))
+        conn.commit()
+    job = get_job(job_id)
+    if job and job["pdf_path"] and os.path.exists(job["pdf_path"]):
+        os.remove(job["pdf_path"])
+
+
+def cancel_job(job_id):
+    """Cancel a queued job immediately; ask the worker to stop a running one."""
+    with connect() as conn:
+        conn.execute('''
+            UPDATE ingest_jobs SET cancel_requested = 1, updated_at = ? WHERE id = ? AND status = 'running'
+        ''', (time.time(), job_id))
+        conn.commit()
+    job = get_job(job_id)
+    if job and job["status"] == "queued":
+        finish_job(job_id, "cancelled")
+
+
+def is_cancel_requested(job_id):
+    with connect() as conn:
+        row = conn.execute('SELECT cancel_requested FROM ingest_jobs WHERE id = ?', (job_id,)).fetchone()
+    return bool(row and row[0])
+
+
+def pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def requeue_orphaned_jobs():
+    """Jobs left 'running' by a dead worker go back to the queue; they resume from their last finished page."""
+    init_jobs_table()
+    with connect() as conn:
+        rows = conn.execute("SELECT id, worker_pid FROM ingest_jobs WHERE status = 'running'").fetchall()
+        orphaned = [(job_id,) for job_id, pid in rows if not pid_alive(pid)]
+        conn.executemany("UPDATE ingest_jobs SET status = 'queued', worker_pid = NULL WHERE id = ?", orphaned)
+        conn.commit()
+    return len(orphaned)
+
+
+def with_eta(progress, started_at):
+    """Add elapsed/ETA seconds to pipeline progress, extrapolating from pages finished so far."""
+    elapsed = time.time() - started_at
+    done = progress.get("upsert", 0) + progress.get("skipped", 0)
+    remaining = max(progress.get("total", 0) - done, 0)
+    rate = progress.get("upsert", 0) / elapsed if elapsed > 0 else 0
+    eta = remaining / rate if rate > 0 else None
+    return {**progress, "elapsed_seconds": elapsed, "eta_seconds": eta}
+
+
+def acquire_worker_lock():
+    """Take the worker lock, returning its open file (keep it open to hold the lock); None if another worker has it."""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    lock_file = open(WORKER_LOCK_FILE, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def worker_pid():
+    try:
+        with open(WORKER_PID_FILE) as f:
+            pid = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return int(pid) if pid.isdigit() else None
+
+
+def ensure_worker():
+    """Start a background ingest worker process unless one is already running.
+
+    Two callers racing here may both start one; the second worker fails to take the worker lock and exits.
+    """
+    lock_file = acquire_worker_lock()
+    if lock_file is None:
+        return worker_pid()
+    lock_file.close()
+    process = subprocess.Popen([sys.executable, "-m", "app.worker"], cwd=os.getcwd(), start_new_session=True)
+    return process.pid
@@ -1,23 +1,61 @@
-import io, os, json, sqlite3, shutil
+import io, os, json, shutil, hashlib, logging, threading
+from concurrent.futures import ThreadPoolExecutor
 import pypdfium2
-import streamlit as st
-import pytesseract
-from PIL import Image
-from dotenv import load_dotenv
-from surya.models import load_predictors
-from surya.layout import LayoutResult
-from surya.settings import settings
-from surya.debug.draw import draw_polys_on_image
-import chromadb
-from openai import OpenAI
-from chromadb.utils import embedding_functions
-
-
-# Load layout predictors (cached)
-@st.cache_resource()
-def load_predictors_cached():
-    return load_predictors()
-predictors = load_predictors_cached()
+from PIL import Image, ImageDraw, ImageFont
+from app.helpers.db import connect, insert_layout_analysis, select_deferred_regions, update_layout_analysis_texts
+from app.helpers.page_cache import page_cache
+from app.helpers.chunking import page_text
+from app.helpers.document_model import Block, Page
+from app.helpers.ocr import ocr_regions, record_ocr_timings
+from app.helpers.documents import DEFAULT_DOCUMENT, document_text_dir, document_pdf_path
+from app.helpers.metrics import metrics, span, log_event
+from app.helpers.text_layer import TEXT_LAYER, looks_garbled
+from app.helpers.region_policy import OCR, DEFER, SKIP, region_policy
+
+# Surya (and torch) are imported on first use: the chat path, the API and the job queue never need them.
+# Render DPIs mirror surya.settings (same env variables and defaults) so page fingerprints are unchanged.
+IMAGE_DPI = int(os.getenv("IMAGE_DPI", 96))
+IMAGE_DPI_HIGHRES = int(os.getenv("IMAGE_DPI_HIGHRES", 192))
+
+_predictors = None
+_predictors_lock = threading.Lock()
+
+
+def get_predictors():
+    """Surya predictors, loaded once per process on first call (tens of seconds cold)."""
+    global _predictors
+    with _predictors_lock:
+        if _predictors is None:
+            from surya.models import load_predictors
+            with span("layout.load_predictors"):
+                _predictors = load_predictors()
+        return _predictors
+
+
+def draw_polys_on_image(corners, image, labels=None, label_font_size=10, color="red"):
+    """Outline polygons (and their labels) on image in place, like surya.debug.draw, without importing surya."""
+    draw = ImageDraw.Draw(image)
+    try:
+        font = ImageFont.load_default(label_font_size)
+    except TypeError:
+        # Pillow < 10.1: fixed-size bitmap font
+        font = ImageFont.load_default()
+    for i, poly in enumerate(corners):
+        draw.polygon([tuple(p) for p in poly], outline=color, width=2)
+        if labels is not None:
+            x, y = min(p[0] for p in poly), min(p[1] for p in poly)
+            draw.text((x, max(0, y - label_font_size - 2)), labels[i], fill=color, font=font)
+    return image
+
+# Bump whenever layout/OCR/chunking output changes so incremental ingestion re-processes every page
+PIPELINE_VERSION = "5"
+# Pages per layout predictor call; small batches keep CPU memory in check while amortizing per-call overhead
+LAYOUT_BATCH_SIZE = int(os.getenv("LAYOUT_BATCH_SIZE", 4))
+# Also write each page's text to data/text_data/<doc>/all_pages/page_N.md, on a background thread.
+# Ingestion itself hands pages to chunking in memory and stores them in SQLite; nothing reads these files.
+EXPORT_PAGE_MARKDOWN = os.getenv("EXPORT_PAGE_MARKDOWN", "0") == "1"
+
+_export_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="page-export")
 
 # --- Directory Utils ---
 def create_dirs(page_number, base_dir="text_data"):
@@ -37,88 +75,260 @@ def empty_directory(path, skip_dirs=None):
         elif os.path.isdir(item_path):
             shutil.rmtree(item_path)
 
+def remove_page_files(page_number, base_dir="text_data"):
+    shutil.rmtree(os.path.join("data", base_dir, "individual_pages", f"page_{page_number}"), ignore_errors=True)
+    all_pages_path = os.path.join("data", base_dir, "all_pages", f"page_{page_number}.md")
+    if os.path.exists(all_pages_path):
+        os.remove(all_pages_path)
+
+def remove_document_files(doc_id):
+    shutil.rmtree(os.path.join("data", document_text_dir(doc_id)), ignore_errors=True)
+    if os.path.exists(document_pdf_path(doc_id)):
+        os.remove(document_pdf_path(doc_id))
+
 # --- PDF Utils ---
 def open_pdf(pdf_file):
     return pypdfium2.PdfDocument(io.BytesIO(pdf_file.getvalue()))
 
-@st.cache_data()
 def page_counter(pdf_file):
-    doc = open_pdf(pdf_file)
-    count = len(doc)
-    doc.close()
-    return count
-
-@st.cache_data()
-def get_page_image(pdf_file, page_num, dpi=settings.IMAGE_DPI):
-    doc = open_pdf(pdf_file)
-    renderer = doc.render(pypdfium2.PdfBitmap.to_pil, page_indices=[page_num - 1], scale=dpi / 72)
-    image = list(renderer)[0].convert("RGB")
-    doc.close()
-    return image
+    return page_cache.page_count(pdf_file)
+
+def get_page_image(pdf_file, page_num, dpi=IMAGE_DPI):
+    # Shared with the chatbot: copy before drawing on the returned image
+    return page_cache.get_page(pdf_file, page_num, dpi)
+
+def page_fingerprint(image, dpi=IMAGE_DPI):
+    """Hash of the rendered page pixels, render DPI and pipeline version."""
+    digest = hashlib.sha256(f"{PIPELINE_VERSION}:{dpi}:{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
 
 # --- Core OCR + Storage ---
-def insert_into_db(extracted_texts):
-    conn = sqlite3.connect('application.db')
-    cursor = conn.cursor()
-    for item in extracted_texts:
-        if all(k in item for k in ("poly", "text", "page", "label")):
-            cursor.execute('''
-                INSERT INTO layout_analysis (text, label, page, poly)
-                VALUES (?, ?, ?, ?)
-            ''', (item['text'], item['label'], item['page'], json.dumps(item['poly'])))
-    conn.commit()
-    conn.close()
-
-def save_texts_to_file(text_blocks, output_path):
-    with open(output_path, "w", encoding="utf-8") as f:
-        for obj in text_blocks:
-            if "figure" in obj["label"].lower():
-                continue
-            if all(x not in obj["label"].lower() for x in ["pagefooter", "picture", "pageheader", "table"]):
-                f.write(f"{obj['text']}\n")
-
-def save_page_data(extracted_texts, page_number, base_dir="text_data"):
-    page_dir, _ = create_dirs(page_number, base_dir)
-    all_pages_path = os.path.join("data", base_dir, "all_pages", f"page_{page_number}.md")
-    os.makedirs(os.path.dirname(all_pages_path), exist_ok=True)
+def write_page_markdown(pages, base_dir="text_data"):
+    for page in pages:
+        path = os.path.join("data", base_dir, "all_pages", f"{page.label}.md")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(page_text(page.blocks))
+
+def export_page_markdown(pages, base_dir="text_data"):
+    """Queue the markdown export of pages when EXPORT_PAGE_MARKDOWN is set (the process waits for it at exit)."""
+    if EXPORT_PAGE_MARKDOWN and pages:
+        _export_pool.submit(write_page_markdown, pages, base_dir).add_done_callback(_export_done)
+
+def _export_done(future):
+    if future.exception() is not None:
+        log_event("export.page_markdown", logging.WARNING, error=repr(future.exception()))
 
-    # Save individual and combined markdown files
-    save_texts_to_file(extracted_texts, os.path.join(page_dir, f"page_{page_number}.md"))
-    save_texts_to_file(extracted_texts, all_pages_path)
 
-    insert_into_db(extracted_texts)
+CROP_UPSCALE = 2
 
 
-def upscale_image(img, factor=2):
+def upscale_image(img, factor=CROP_UPSCALE):
     return img.resize((img.width * factor, img.height * factor), Image.LANCZOS)
 
 
-def crop_bounding_boxes_from_image(polys, image, labels, page_number, base_dir="text_data"):
-    page_dir, image_dir = create_dirs(page_number, base_dir)
-    extracted_texts = []
+def crop_box(poly, label):
+    x_min, y_min = min(p[0] for p in poly), min(p[1] for p in poly)
+    x_max, y_max = max(p[0] for p in poly), max(p[1] for p in poly)
+    x_min, x_max = x_min - 10, x_max + 10
+    y_min, y_max = (y_min - 4, y_max + 4) if "footnote" not in label.lower() else (y_min, y_max)
+    return x_min, y_min, x_max, y_max
+
+
+def crop_region(image, poly, label):
+    return upscale_image(image.crop(crop_box(poly, label)))
+
+
+def page_words(words, poly, label):
+    """OCR word boxes of a region crop -> [word, confidence, [left, top, right, bottom]] in page pixels."""
+    if words is None:
+        return None
+    x_min, y_min, _, _ = crop_box(poly, label)
+    offsets = (x_min, y_min, x_min, y_min)
+    return [
+        [word, confidence, [round(offset + v / CROP_UPSCALE, 1) for offset, v in zip(offsets, box)]]
+        for word, confidence, box in words
+    ]
+
+
+def crop_page_regions(polys, image, labels, page_number, base_dir="text_data", text_layer=None, plan=None):
+    """Crop the regions of a page that still need OCR or whose crop the region policy keeps.
 
-    for i, poly in enumerate(polys):
-        x_min, y_min = min(p[0] for p in poly), min(p[1] for p in poly)
-        x_max, y_max = max(p[0] for p in poly), max(p[1] for p in poly)
-        x_min, x_max = x_min - 10, x_max + 10
-        y_min, y_max = (y_min - 4, y_max + 4) if "footnote" not in labels[i].lower() else (y_min, y_max)
+    plan is the region policy's (action, save_crop) per region. Returns (region indices, OCR tasks)
+    for the "ocr" regions not already read from the text layer (text_layer: {index: text}).
+    """
+    plan = plan or region_policy.plan(labels)
+    text_layer = text_layer or {}
+    indices, tasks = [], []
+    for i, (poly, (action, save_crop)) in enumerate(zip(polys, plan)):
+        needs_ocr = action == OCR and i not in text_layer
+        if not needs_ocr and not save_crop:
+            continue
+        cropped = crop_region(image, poly, labels[i])
+        if needs_ocr:
+            indices.append(i)
+            tasks.append((cropped, labels[i]))
+        if save_crop:
+            _, image_dir = create_dirs(page_number, base_dir)
+            cropped.save(os.path.join(image_dir, f"{labels[i]}.png"))
+    return indices, tasks
+
+
+def text_layer_regions(pdf_key, page_number, polys, labels, image_width, plan=None):
+    """{region index: text} for the "ocr" regions whose PDF text-layer text can replace OCR."""
+    if not TEXT_LAYER or pdf_key is None:
+        return {}
+    plan = plan or region_policy.plan(labels)
+    wanted = [i for i, (action, _) in enumerate(plan) if action == OCR]
+    if not wanted:
+        return {}
+    texts = page_cache.text_regions(pdf_key, page_number, [polys[i] for i in wanted], image_width)
+    if texts is None:
+        return {}
+    return {i: text for i, text in zip(wanted, texts) if not looks_garbled(text)}
+
+
+def build_page(polys, labels, indices, results, page_number, doc_id=DEFAULT_DOCUMENT, text_layer=None, deferred=(),
+               timings=None):
+    """A Page of the read regions in region order; each block's source says whether its text came from
+    the text layer or OCR. Deferred regions are kept without text (source "deferred") for ocr_deferred_regions().
+    """
+    record_ocr_timings(page_number, [labels[i] for i in indices], results, doc_id, timings)
+    texts = {i: ("", "deferred", None) for i in deferred}
+    texts.update({i: (result.text, "ocr", page_words(result.words, polys[i], labels[i]))
+                  for i, result in zip(indices, results)})
+    texts.update({i: (text, "text_layer", None) for i, text in (text_layer or {}).items()})
+    blocks = [Block(text, labels[i], polys[i], i, source, words) for i, (text, source, words) in sorted(texts.items())]
+    return Page(page_number, blocks, doc_id)
+
+
+def page_text_path(page):
+    """How a page's regions were read: "text_layer", "ocr", "mixed", or "none" without text regions."""
+    sources = {block.source for block in page.blocks if block.source != "deferred"}
+    return sources.pop() if len(sources) == 1 else ("mixed" if sources else "none")
+
+
+def crop_bounding_boxes_from_image(polys, image, labels, page_number, base_dir="text_data", pdf_key=None):
+    return ocr_pages([(polys, image, labels, page_number)], base_dir=base_dir, pdf_key=pdf_key)[0]
+
+
+def ocr_pages(pages, doc_id=DEFAULT_DOCUMENT, base_dir=None, pdf_key=None, policy=None, timings=None):
+    """Read the regions of several pages of one document: text layer first, then one process-pool OCR pass.
+
+    pages is a list of (polys, image, labels, page_number); pdf_key (a page_cache document key)
+    enables the text-layer fast path. The region policy (default: REGION_POLICY) decides per label
+    which regions are read now, deferred or skipped. Per-region OCR times are appended to timings
+    when given. Returns a document_model.Page per page, in input order.
+    """
+    policy = policy or region_policy
+    base_dir = base_dir or document_text_dir(doc_id)
+    page_numbers = [n for *_, n in pages]
+    plans = [policy.plan(labels) for _, _, labels, _ in pages]
+    with span("text_layer.extract", doc_id=doc_id, pages=page_numbers) as extra:
+        text_layers = [
+            text_layer_regions(pdf_key, n, polys, labels, image.width, plan)
+            for (polys, image, labels, n), plan in zip(pages, plans)
+        ]
+        extra["regions"] = sum(len(layer) for layer in text_layers)
+    with span("ocr.crop", doc_id=doc_id, pages=page_numbers):
+        prepared = [
+            crop_page_regions(polys, image, labels, n, base_dir, layer, plan)
+            for (polys, image, labels, n), layer, plan in zip(pages, text_layers, plans)
+        ]
+    tasks = [task for _, page_tasks in prepared for task in page_tasks]
+    with span("ocr.regions", doc_id=doc_id, pages=page_numbers, regions=len(tasks)):
+        results = iter(ocr_regions(tasks))
 
-        cropped = upscale_image(image.crop((x_min, y_min, x_max, y_max)))
-        
-        if "figure" not in labels[i].lower():
-            config = '--psm 6' if any(x in labels[i].lower() for x in ["equation", "table"]) else ''
-            text = pytesseract.image_to_string(cropped, config=config)
-            extracted_texts.append({"text": text, "label": labels[i], "poly": poly, "page": f"page_{page_number}"})
+    built = []
+    for (polys, _, labels, page_number), (indices, page_tasks), layer, plan in zip(pages, prepared, text_layers, plans):
+        page_results = [next(results) for _ in page_tasks]
+        deferred = [i for i, (action, _) in enumerate(plan) if action == DEFER]
+        page = build_page(polys, labels, indices, page_results, page_number, doc_id, layer, deferred, timings)
+        built.append(page)
 
-        cropped.save(os.path.join(image_dir, f"{labels[i]}.png"))
-    save_page_data(extracted_texts, page_number, base_dir)
-    return extracted_texts
+        path = page_text_path(page)
+        skipped = sum(1 for action, _ in plan if action == SKIP)
+        metrics.increment("text_layer.pages", path=path)
+        metrics.increment("text_layer.regions", len(layer))
+        metrics.increment("ocr.regions", len(page_tasks))
+        metrics.increment("regions.deferred", len(deferred))
+        metrics.increment("regions.skipped", skipped)
+        metrics.increment("regions.crops_saved", sum(1 for _, save_crop in plan if save_crop))
+        log_event("text_layer.page", doc_id=doc_id, page=page_number, path=path,
+                  text_layer_regions=len(layer), ocr_regions=len(page_tasks),
+                  deferred_regions=len(deferred), skipped_regions=skipped)
 
+    # One transaction for the whole batch of pages
+    with span("ocr.save", doc_id=doc_id, pages=page_numbers), connect() as conn:
+        insert_layout_analysis(built, conn)
+        conn.commit()
+    export_page_markdown(built, base_dir)
+    return built
 
-def layout_detection(img, page_number):
-    pred = predictors["layout"]([img])[0]
+
+def ocr_deferred_regions(doc_id=DEFAULT_DOCUMENT, pages=None, dpi=IMAGE_DPI_HIGHRES):
+    """Read the regions the policy deferred (e.g. tables) of a document's pages, all by default.
+
+    Renders each page from the stored PDF, tries the text layer, OCRs the rest and updates
+    their layout_analysis rows, then re-chunks, re-embeds and re-upserts those pages so the
+    new text is retrievable. Writes the indexes, so it runs on the worker as a "deferred" job
+    (jobs.enqueue_document_job). Returns the number of regions read.
+    """
+    rows = select_deferred_regions(doc_id, None if pages is None else [f"page_{n}" for n in pages])
+    if not rows:
+        return 0
+    with open(document_pdf_path(doc_id), "rb") as f:
+        pdf_key = page_cache.open_document(f.read())
+    by_page = {}
+    for row_id, page, poly, label in rows:
+        by_page.setdefault(int(page.split("_")[1]), []).append((row_id, json.loads(poly), label))
+
+    updates = []
+    with span("ocr.deferred", doc_id=doc_id, pages=sorted(by_page), regions=len(rows)):
+        for page_number, regions in by_page.items():
+            image = page_cache.render(pdf_key, page_number, dpi)
+            polys, labels = [poly for _, poly, _ in regions], [label for _, _, label in regions]
+            plan = [(OCR, False)] * len(regions)
+            layer = text_layer_regions(pdf_key, page_number, polys, labels, image.width, plan)
+            indices, tasks = crop_page_regions(polys, image, labels, page_number, text_layer=layer, plan=plan)
+            for i, result in zip(indices, ocr_regions(tasks)):
+                words = page_words(result.words, polys[i], labels[i])
+                updates.append((result.text, "ocr", None if words is None else json.dumps(words), regions[i][0]))
+            updates.extend((text, "text_layer", None, regions[i][0]) for i, text in layer.items())
+    update_layout_analysis_texts(updates)
+    metrics.increment("regions.deferred_read", len(updates))
+    reindex_pages([f"page_{n}" for n in sorted(by_page)], doc_id)
+    return len(updates)
+
+
+def reindex_pages(page_labels, doc_id=DEFAULT_DOCUMENT):
+    """Rebuild the chunks, FTS5 rows and vectors of pages from their stored layout_analysis rows."""
+    # Imported here: the OpenAI client and vector store stay out of processes that only run layout/OCR
+    from app.helpers.embeddings import generate_embeddings, insert_embeddings_into_vector_db
+    with span("ingest.reindex", doc_id=doc_id, pages=page_labels):
+        chunked_documents = generate_embeddings(page_labels, doc_id)
+        insert_embeddings_into_vector_db(chunked_documents, replace_pages=page_labels, doc_id=doc_id)
+
+
+def prediction_polys_labels(pred):
     polys = [p.polygon for p in pred.bboxes]
     labels = [f"{p.label}-{p.position}-{round(p.top_k[p.label], 2)}" for p in pred.bboxes]
+    return polys, labels
+
+
+def predict_layout(images, doc_id=None, pages=None, batch_size=LAYOUT_BATCH_SIZE):
+    """Run the layout predictor on page images, batch_size at a time, timed as a layout.predict span."""
+    with span("layout.predict", doc_id=doc_id, pages=pages, images=len(images)):
+        return get_predictors()["layout"](images, batch_size=batch_size)
+
+
+def layout_detection(img, page_number, pdf_file=None):
+    """Layout, then text layer / OCR, for one rendered page; pass pdf_file to enable the text-layer fast path."""
+    pred = predict_layout([img], pages=[page_number])[0]
+    polys, labels = prediction_polys_labels(pred)
     layout_img = draw_polys_on_image(polys, img.copy(), labels=labels, label_font_size=40)
-    crop_bounding_boxes_from_image(polys, img, labels, page_number)
+    pdf_key = page_cache.open_document(pdf_file) if pdf_file is not None else None
+    crop_bounding_boxes_from_image(polys, img, labels, page_number, pdf_key=pdf_key)
     return layout_img, pred
+
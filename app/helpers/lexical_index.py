@@ -0,0 +1,100 @@
+import re
+import sqlite3
+
+from app.helpers.db import DATABASE_PATH
+from app.helpers.documents import DEFAULT_DOCUMENT
+
+# SQLite FTS5 index over chunk text, written in the same transaction as the chunks table.
+# Queries need no embedding call: they serve the lexical-only path and the lexical half of hybrid retrieval.
+FTS_TOKENIZER = "porter unicode61 remove_diacritics 2"
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "do", "does", "for", "from", "how", "in", "is", "it",
+    "of", "on", "or", "that", "the", "this", "to", "was", "what", "when", "where", "which", "who", "why", "with",
+}
+
+
+def init_lexical_index(cursor):
+    cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+            id UNINDEXED, doc_id UNINDEXED, page UNINDEXED, text, tokenize = '{FTS_TOKENIZER}'
+        )
+    """)
+
+
+def ensure_lexical_index(cursor):
+    """Create the index if missing, backfilling it from an existing chunks table."""
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone()
+    if exists:
+        return
+    init_lexical_index(cursor)
+    backfill_lexical_index(cursor)
+
+
+def backfill_lexical_index(cursor):
+    """Index every row of the chunks table, if there is one."""
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(chunks)")]
+    if not columns:
+        return
+    # The (id, text) chunks table from before multi-document support has no doc_id / page
+    selected = ", ".join(column if column in columns else "NULL" for column in ("id", "doc_id", "page", "text"))
+    cursor.execute(f"INSERT INTO chunks_fts (id, doc_id, page, text) SELECT {selected} FROM chunks")
+
+
+def drop_lexical_index(cursor):
+    cursor.execute("DROP TABLE IF EXISTS chunks_fts")
+
+
+def delete_lexical_chunks(cursor, doc_id, pages=None):
+    if pages is None:
+        cursor.execute("DELETE FROM chunks_fts WHERE doc_id = ?", (doc_id,))
+    else:
+        cursor.executemany("DELETE FROM chunks_fts WHERE doc_id = ? AND page = ?", [(doc_id, page) for page in pages])
+
+
+def index_chunks(cursor, chunked_documents):
+    cursor.executemany(
+        "INSERT INTO chunks_fts (id, doc_id, page, text) VALUES (?, ?, ?, ?)",
+        [(doc["id"], doc.get("doc_id", DEFAULT_DOCUMENT), doc.get("page"), doc["text"]) for doc in chunked_documents]
+    )
+
+
+def fts_query(question):
+    """Turn free text into an FTS5 OR-query of quoted terms.
+
+    Terms like "AB-1234" or "3.2" are quoted whole, so the tokenizer matches them as phrases.
+    """
+    terms = re.findall(r"\w[\w.\-/]*\w|\w", question)
+    terms = [t for t in dict.fromkeys(terms) if t.lower() not in STOPWORDS] or terms
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def lexical_search(question, n_results=5, doc_ids=None, db_path=DATABASE_PATH):
+    """BM25-ranked (documents, ids) for the question, best first."""
+    match = fts_query(question)
+    if not match:
+        return [], []
+    sql = "SELECT id, text FROM chunks_fts WHERE chunks_fts MATCH ?"
+    params = [match]
+    if doc_ids:
+        sql += f" AND doc_id IN ({','.join('?' * len(doc_ids))})"
+        params.extend(doc_ids)
+    sql += " ORDER BY bm25(chunks_fts) LIMIT ?"
+    params.append(n_results)
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        ensure_lexical_index(cursor)
+        conn.commit()
+        rows = cursor.execute(sql, params).fetchall()
+    return [text for _, text in rows], [chunk_id for chunk_id, _ in rows]
+
+
+def reciprocal_rank_fusion(rankings, weights=None, k=60):
+    """Fuse ranked (documents, ids) lists; a chunk scores sum(weight / (k + rank)) over the lists it appears in."""
+    weights = weights or [1.0] * len(rankings)
+    scores, texts = {}, {}
+    for (documents, ids), weight in zip(rankings, weights):
+        for rank, (text, chunk_id) in enumerate(zip(documents, ids)):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + weight / (k + rank + 1)
+            texts[chunk_id] = text
+    fused = sorted(scores, key=scores.get, reverse=True)
+    return [texts[chunk_id] for chunk_id in fused], fused
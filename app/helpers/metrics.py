@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+
+# Stdlib only: imported by OCR worker processes, the ingest worker, the API and the Streamlit app.
+# Metrics are per process; the API serves its own at GET /metrics, the ingest worker on METRICS_PORT.
+
+# JSON-lines structured log of spans and events: a file path, or "-" for stderr (off when unset)
+METRICS_LOG = os.getenv("METRICS_LOG")
+# DEBUG also logs per-region OCR spans
+METRICS_LOG_LEVEL = os.getenv("METRICS_LOG_LEVEL", "INFO").upper()
+# Latency samples kept per timer for percentiles (reservoir sampling beyond that)
+TIMER_SAMPLES = int(os.getenv("METRICS_TIMER_SAMPLES", 1024))
+# Per-stage profiles of ingestion runs: "cprofile" or "pyinstrument" (off when unset)
+PROFILE_INGEST = os.getenv("PROFILE_INGEST", "").lower()
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join("data", "profiles"))
+
+logger = logging.getLogger("layout_rag.metrics")
+logger.propagate = False
+logger.setLevel(METRICS_LOG_LEVEL)
+if METRICS_LOG:
+    _handler = logging.StreamHandler() if METRICS_LOG == "-" else logging.FileHandler(METRICS_LOG, encoding="utf-8")
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+else:
+    logger.addHandler(logging.NullHandler())
+
+
+def metric_key(name, labels):
+    """'ocr.region' + {'label': 'Table'} -> 'ocr.region{label=Table}'"""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+
+class Timer:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.samples) < TIMER_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            i = random.randrange(self.count)
+            if i < TIMER_SAMPLES:
+                self.samples[i] = seconds
+
+    def summary(self):
+        ordered = sorted(self.samples)
+
+        def pct(q):
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.count if self.count else None,
+            "p50_seconds": pct(0.5),
+            "p95_seconds": pct(0.95),
+            "max_seconds": self.max,
+        }
+
+
+class Metrics:
+    """Thread-safe in-process counters and timers, keyed by name and labels."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+        self.started_at = time.time()
+
+    def increment(self, name, value=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.timers.setdefault(key, Timer()).observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "uptime_seconds": time.time() - self.started_at,
+                "counters": dict(sorted(self.counters.items())),
+                "timers": {key: timer.summary() for key, timer in sorted(self.timers.items())},
+            }
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+            self.started_at = time.time()
+
+
+metrics = Metrics()
+
+
+def log_event(event, level=logging.INFO, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, default=str))
+
+
+@contextmanager
+def span(name, level=logging.INFO, labels=None, **fields):
+    """Time a block into the `name` timer (split by labels) and log it as a structured event.
+
+    fields (page numbers, counts, ...) only go to the log; the yielded dict can add more.
+    """
+    labels = labels or {}
+    extra = {}
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield extra
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - t0
+        metrics.observe(name, seconds, **labels)
+        if error:
+            metrics.increment(f"{name}.errors", **labels)
+        log_event(name, level, seconds=round(seconds, 6), **labels, **fields, **extra,
+                  **({"error": error} if error else {}))
+
+
+def record_usage(endpoint, usage):
+    """Count an OpenAI API call and the tokens its usage block reports (usage may be None)."""
+    metrics.increment("openai.requests", endpoint=endpoint)
+    if usage is None:
+        return
+    for field in ("prompt_tokens", "completion_tokens", "total_tokens"):
+        tokens = getattr(usage, field, None)
+        if tokens:
+            metrics.increment(f"openai.{field}", tokens, endpoint=endpoint)
+
+
+def prometheus_text(snapshot=None):
+    """Render a snapshot in the Prometheus text format (counters, and timers as summaries)."""
+    snapshot = snapshot or metrics.snapshot()
+
+    def series(key, suffix=""):
+        name, _, labels = key.partition("{")
+        name = "rag_" + name.replace(".", "_") + suffix
+        if not labels:
+            return name
+        pairs = [pair.split("=", 1) for pair in labels.rstrip("}").split(",")]
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    lines = [f"{series(key, '_total')} {value}" for key, value in snapshot["counters"].items()]
+    for key, timer in snapshot["timers"].items():
+        lines.append(f"{series(key, '_seconds_count')} {timer['count']}")
+        lines.append(f"{series(key, '_seconds_sum')} {timer['total_seconds']}")
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Serve this process's metrics at /metrics (JSON, or Prometheus text with ?format=prometheus)."""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if not self.path.startswith("/metrics"):
+                self.send_error(404)
+                return
+            if "format=prometheus" in self.path:
+                body, content_type = prometheus_text().encode(), "text/plain; version=0.0.4"
+            else:
+                body, content_type = json.dumps(metrics.snapshot()).encode(), "application/json"
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+@contextmanager
+def profiled(name, mode=None):
+    """Profile the calling thread into PROFILE_DIR/<name>.prof (cProfile) or .html (pyinstrument).
+
+    A no-op unless mode (default PROFILE_INGEST) is set. Both profilers only see the thread they
+    run in, so the ingest pipeline profiles each stage thread separately.
+    """
+    mode = PROFILE_INGEST if mode is None else mode
+    if not mode:
+        yield None
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name)
+    if mode == "pyinstrument":
+        from pyinstrument import Profiler
+        profiler = Profiler(async_mode="disabled")
+        profiler.start()
+        try:
+            yield profiler
+        finally:
+            profiler.stop()
+            path += ".html"
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            path += ".prof"
+            profiler.dump_stats(path)
+    log_event("profile.saved", path=path)
+    print(f"🔬 Profile written to {path}")
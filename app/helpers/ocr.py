@@ -0,0 +1,158 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from app.helpers.metrics import metrics, log_event
+
+# Kept free of streamlit/surya imports: worker processes import this module on spawn
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", os.cpu_count() or 1))
+# "spawn" keeps torch/Surya state out of the workers
+OCR_MP_CONTEXT = os.getenv("OCR_MP_CONTEXT", "spawn")
+# "tesserocr": one warm in-process Tesseract per worker, images passed in memory, word boxes included.
+# "pytesseract": a tesseract subprocess and temp file per region, text only. "auto" prefers tesserocr.
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto")
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+
+# words: [(word, confidence 0-100, (left, top, right, bottom) in crop pixels)], None when the backend has no boxes
+OcrResult = namedtuple("OcrResult", ["text", "seconds", "words"])
+
+_pools = {}
+_pools_lock = threading.Lock()
+_engines = threading.local()
+
+
+def tesseract_psm(label):
+    # 6: a single uniform block; 3: automatic page segmentation (Tesseract's default)
+    return 6 if any(x in label.lower() for x in ["equation", "table"]) else 3
+
+
+def tesseract_config(label):
+    return f'--psm {tesseract_psm(label)}'
+
+
+class TesserocrEngine:
+    """A Tesseract instance kept loaded for the life of the process; not thread-safe, one per thread."""
+    name = "tesserocr"
+
+    def __init__(self, lang=OCR_LANG):
+        import tesserocr
+        self.tesserocr = tesserocr
+        self.api = tesserocr.PyTessBaseAPI(lang=lang)
+
+    def recognize(self, image, label):
+        tesserocr, api = self.tesserocr, self.api
+        api.SetPageSegMode(tesserocr.PSM.SINGLE_BLOCK if tesseract_psm(label) == 6 else tesserocr.PSM.AUTO)
+        api.SetImage(image)
+        api.Recognize()
+        text = api.GetUTF8Text()
+        words, level, iterator = [], tesserocr.RIL.WORD, api.GetIterator()
+        if iterator is not None:
+            for word in tesserocr.iterate_level(iterator, level):
+                box = word.BoundingBox(level)
+                if box is not None:
+                    words.append((word.GetUTF8Text(level), round(word.Confidence(level), 2), box))
+        return text, words
+
+
+class PytesseractEngine:
+    """The tesseract binary via pytesseract: a subprocess and a temp image file per region."""
+    name = "pytesseract"
+
+    def __init__(self, lang=OCR_LANG):
+        import pytesseract
+        self.pytesseract = pytesseract
+        self.lang = lang
+
+    def recognize(self, image, label):
+        return self.pytesseract.image_to_string(image, lang=self.lang, config=tesseract_config(label)), None
+
+
+OCR_ENGINES = {"tesserocr": TesserocrEngine, "pytesseract": PytesseractEngine}
+
+
+def create_ocr_engine(backend=OCR_BACKEND):
+    if backend != "auto":
+        return OCR_ENGINES[backend]()
+    try:
+        return TesserocrEngine()
+    except (ImportError, RuntimeError) as exc:
+        # tesserocr not installed, or its libtesseract can't find OCR_LANG's traineddata
+        log_event("ocr.backend_fallback", logging.WARNING, error=repr(exc))
+        return PytesseractEngine()
+
+
+def get_ocr_engine():
+    """This thread's OCR engine, created on first use (in pool workers: once per process)."""
+    engine = getattr(_engines, "engine", None)
+    if engine is None:
+        engine = _engines.engine = create_ocr_engine()
+    return engine
+
+
+def ocr_backend():
+    """Name of the OCR engine this process ends up with ("tesserocr" or "pytesseract"); pool workers choose alike."""
+    return get_ocr_engine().name
+
+
+def ocr_region(task):
+    """OCR one (image, label) region; returns an OcrResult."""
+    cropped, label = task
+    t0 = time.perf_counter()
+    text, words = get_ocr_engine().recognize(cropped, label)
+    return OcrResult(text, time.perf_counter() - t0, words)
+
+
+def get_ocr_pool(max_workers=OCR_WORKERS):
+    # Documents ingested concurrently share one pool
+    with _pools_lock:
+        if max_workers not in _pools:
+            context = multiprocessing.get_context(OCR_MP_CONTEXT)
+            _pools[max_workers] = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+        return _pools[max_workers]
+
+
+def shutdown_ocr_pools():
+    for pool in _pools.values():
+        pool.shutdown(cancel_futures=True)
+    _pools.clear()
+
+
+def ocr_regions(tasks, max_workers=OCR_WORKERS):
+    """OCR (image, label) tasks on the process pool; results come back in task order."""
+    if max_workers <= 1 or len(tasks) <= 1:
+        return [ocr_region(task) for task in tasks]
+    chunksize = max(1, len(tasks) // (max_workers * 4))
+    return list(get_ocr_pool(max_workers).map(ocr_region, tasks, chunksize=chunksize))
+
+
+def record_ocr_timings(page_number, labels, results, doc_id=None, timings=None):
+    """Observe per-region OCR times into the metrics; also append them to timings (one ingest run's list)."""
+    for label, (text, seconds, _) in zip(labels, results):
+        if timings is not None:
+            timings.append({"page": page_number, "label": label, "seconds": seconds})
+        kind = label.split("-")[0]
+        # Measured inside the worker process, so it excludes pool queueing and image pickling
+        metrics.observe("ocr.region", seconds, label=kind)
+        log_event("ocr.region", logging.DEBUG, doc_id=doc_id, page=page_number, label=kind,
+                  seconds=round(seconds, 6), chars=len(text))
+
+
+def ocr_timing_summary(timings):
+    """Aggregate per-region OCR timings by Surya label (e.g. 'Table', 'Equation')."""
+    grouped = defaultdict(list)
+    for t in timings:
+        grouped[t["label"].split("-")[0]].append(t["seconds"])
+    return {
+        label: {
+            "regions": len(seconds),
+            "total_seconds": sum(seconds),
+            "mean_seconds": sum(seconds) / len(seconds),
+            "max_seconds": max(seconds),
+        }
+        for label, seconds in sorted(grouped.items(), key=lambda kv: -sum(kv[1]))
+    }
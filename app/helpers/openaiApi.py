@@ -1,51 +1,118 @@
 import os
+import asyncio
 from dotenv import load_dotenv
-import chromadb
-from openai import OpenAI
-from chromadb.utils import embedding_functions
+import httpx
+from openai import OpenAI, AsyncOpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
 import re
+import time
 import pandas as pd
 
+from app.helpers.vector_store import get_vector_store
+from app.helpers.db import get_collection_version
+from app.helpers.documents import chunk_source_key, citation_label, parse_source_key
+from app.helpers.lexical_index import lexical_search, reciprocal_rank_fusion
+from app.helpers.metrics import metrics, span, record_usage
+from app.helpers.jobs import queue_deferred_reads
+from app.helpers.query_cache import (
+    cached_query_embedding, lookup_query_embedding, store_query_embedding, normalize_question,
+    get_cached_answer, put_cached_answer,
+)
+
 load_dotenv()
 openai_key = os.getenv("OPENAI_API_KEY")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
 
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-    api_key=openai_key, model_name="text-embedding-3-small",
-)
+# "hybrid" fuses BM25 and vector rankings, "vector" is dense-only, "lexical" answers retrieval with no embedding call
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# Candidates taken from each ranking before fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 20))
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", 1.0))
+# Embedding failures that make hybrid retrieval fall back to lexical results
+EMBEDDING_OUTAGE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
 
-# chroma client
-chroma_client = chromadb.PersistentClient(path="./data/chroma_persistent_storage")
-collection_name = "document_qa_collection"
-collection = chroma_client.get_or_create_collection(
-    name=collection_name,embedding_function=openai_ef
-)
+# Queue a worker read of the deferred regions (tables by default) of the pages an answer cites
+READ_DEFERRED_ON_ANSWER = os.getenv("READ_DEFERRED_ON_ANSWER", "1") == "1"
 
-client = OpenAI(api_key=openai_key)
+# Connection pool shared by every request handled by the async (API) path
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 100))
 
-def query_documents(question, n_results=5):
-    openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-        api_key=openai_key, model_name="text-embedding-3-small"
-    )
+_client = None
+_async_client = None
 
-    collection = chroma_client.get_or_create_collection(
-        name=collection_name, embedding_function=openai_ef
-    )
-    print(f"🔍 Querying collection: {collection.name}")
+def get_client():
+    # Created on first use, like the vector store: importing this module opens no connections
+    global _client
+    if _client is None:
+        _client = OpenAI(api_key=openai_key, base_url=os.getenv("OPENAI_BASE_URL") or None)
+    return _client
 
-    results = collection.query(query_texts=question, n_results=n_results)
-    relevant_chunks = [doc for sublist in results["documents"] for doc in sublist]
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(
+            api_key=openai_key,
+            base_url=os.getenv("OPENAI_BASE_URL") or None,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_CONNECTIONS // 5,
+            )),
+        )
+    return _async_client
 
-    citations = []
-    for idx, _ in enumerate(results["documents"][0]):
-        doc_id = results["ids"][0][idx]
-        citations.append(doc_id)
+def embed_text(text):
+    with span("query.embed"):
+        response = get_client().embeddings.create(input=text, model=EMBEDDING_MODEL)
+    record_usage("embeddings", response.usage)
+    return response.data[0].embedding
 
-    return relevant_chunks, citations
+def embed_question(question):
+    return cached_query_embedding(question, EMBEDDING_MODEL, embed_text)
+
+def fuse_rankings(dense, lexical, n_results):
+    documents, ids = reciprocal_rank_fusion([dense, lexical], [1.0, HYBRID_LEXICAL_WEIGHT])
+    return documents[:n_results], ids[:n_results]
+
+def query_documents(question, n_results=5, doc_ids=None, mode=None):
+    """Best chunks for the question, from every document or only those in doc_ids.
+
+    mode (default RETRIEVAL_MODE) is "vector", "lexical" or "hybrid"; hybrid falls back to the
+    lexical ranking when the embedding API is unavailable.
+    """
+    mode = mode or RETRIEVAL_MODE
+    print(f"🔍 Querying {'FTS5' if mode == 'lexical' else type(get_vector_store()).__name__} ({mode})"
+          + (f" in {', '.join(doc_ids)}" if doc_ids else ""))
+    embedding = None
+    if mode != "lexical":
+        try:
+            embedding = embed_question(question)
+        except EMBEDDING_OUTAGE_ERRORS as e:
+            if mode == "vector":
+                raise
+            print(f"⚠️ Embedding unavailable ({type(e).__name__}), using lexical retrieval only")
+            metrics.increment("query.lexical_fallbacks")
+            mode = "lexical"
+    return search_documents(question, embedding, n_results, doc_ids, mode)
+
+def search_documents(question, embedding, n_results=5, doc_ids=None, mode=None):
+    """Retrieval for an already embedded question (embedding may be None in lexical mode)."""
+    mode = mode or RETRIEVAL_MODE
+    with span("query.retrieve", labels={"mode": mode}, doc_ids=doc_ids):
+        if mode == "lexical":
+            return lexical_search(question, n_results, doc_ids)
+        # Reopens the store when the ingestion worker changed it since this process last read it
+        store = get_vector_store(get_collection_version())
+        if mode == "vector":
+            return store.query(embedding, n_results=n_results, doc_ids=doc_ids)
+        with span("query.lexical_search"):
+            lexical = lexical_search(question, HYBRID_CANDIDATES, doc_ids)
+        with span("query.vector_search"):
+            dense = store.query(embedding, n_results=HYBRID_CANDIDATES, doc_ids=doc_ids)
+        return fuse_rankings(dense, lexical, n_results)
 
 def construct_advanced_prompt(question, context, citations):
     # Format citations into the context
     formatted_citations = "\n".join(
-        f"[Source {citation.replace('_', ' ')}]" for citation in citations
+        f"[Source {citation_label(citation)}]" for citation in dict.fromkeys(citations)
     )
     
     return f"""
@@ -86,67 +153,206 @@ def format_chunks(relevant_chunks, citations):
         try:
             citation = citations[i] if citations and i < len(citations) else f"Unknown Source {i+1}"
             chunk = relevant_chunks[i] if relevant_chunks and i < len(relevant_chunks) else "No content available"
-            clean_citation = str(citation).split('.')[0].strip()
+            clean_citation = citation_label(chunk_source_key(str(citation)))
             formatted_chunk = f"[Source {clean_citation}]:\n{chunk}"
             formatted_chunks.append(formatted_chunk)
         
-        except Exception as e:
+        except Exception:
             # Fallback for any unexpected errors
             formatted_chunks.append(f"[Source Error]: Unable to format source {i+1}")
     
     return formatted_chunks
 
-def generate_response(question, formatted_chucks, citations):
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-3.5-turbo")
 
+def build_messages(question, formatted_chucks, citations):
     context = "\n\n".join(formatted_chucks)
     prompt = construct_advanced_prompt(question, context, citations)
+    return [
+        {
+            "role": "system",
+            "content": prompt,
+        },
+        {
+            "role": "user",
+            "content": question,
+        },
+    ]
 
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": prompt,
-            },
-            {
-                "role": "user",
-                "content": question,
-            },
-        ],
-    )
+def generate_response(question, formatted_chucks, citations):
+    with span("query.generate", chunks=len(formatted_chucks)):
+        response = get_client().chat.completions.create(
+            model=CHAT_MODEL,
+            messages=build_messages(question, formatted_chucks, citations),
+        )
+    record_usage("chat", response.usage)
 
     answer = response.choices[0].message.content
     return answer
 
+def generate_response_stream(question, formatted_chucks, citations):
+    """Yield the answer's text deltas as the model produces them."""
+    t0 = time.perf_counter()
+    stream = get_client().chat.completions.create(
+        model=CHAT_MODEL,
+        messages=build_messages(question, formatted_chucks, citations),
+        stream=True,
+        # The last chunk then carries the token usage (with no choices)
+        stream_options={"include_usage": True},
+    )
+    usage = None
+    for chunk in stream:
+        usage = chunk.usage or usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+    # Timed by hand: a span around the yields would also count the consumer's time
+    metrics.observe("query.generate", time.perf_counter() - t0)
+    record_usage("chat", usage)
+
 def chunks_used_by_ai(df,pages):
-    ai_pages = ["page_"+str(page) for page in pages]
-    filtered_df = df[df['Pages'].isin(ai_pages)]
-    grouped_df = filtered_df.groupby('Pages')['Chunks'].apply(list).reset_index()
+    filtered_df = df[df['Pages'].isin(pages)]
+    grouped_df = filtered_df.groupby('Pages')[['Chunks', 'Ids']].agg(list).reset_index()
     return grouped_df
     
     
-def retrieve_and_generate(question):
-    chunks,citations = query_documents(question)
-
-    extracted_citations = [citation.split('.')[0] for citation in citations]
+def retrieve_context(question, doc_ids=None):
+    chunks,citations = query_documents(question, doc_ids=doc_ids)
+    extracted_citations = [chunk_source_key(citation) for citation in citations]
     formatted_chunks = format_chunks(chunks, citations)
-    ai_response = generate_response(question, formatted_chunks, extracted_citations).replace("_"," ")
-    # print(ai_response)
-    
-    # print(chunks)
-    matches = re.findall(r'age (\d+)\]', ai_response)
+    return chunks, citations, extracted_citations, formatted_chunks
 
-    # Convert matches to a sorted list of unique page numbers
-    pages = sorted(set(map(int, matches)))
-    # print(chunks)
+def cited_sources(ai_response, extracted_citations):
+    """Source keys ("report/page_3") of the retrieved pages the answer cites, in document/page order."""
+    return [
+        key for key in sorted(set(extracted_citations), key=parse_source_key)
+        if re.search(rf"{re.escape(citation_label(key))}\b", ai_response, re.IGNORECASE)
+    ]
+
+def source_pages(ai_response, chunks, citations, extracted_citations):
+    pages = cited_sources(ai_response, extracted_citations)
 
     df = pd.DataFrame({
         'Chunks': chunks,
-        'Pages': extracted_citations
+        'Pages': extracted_citations,
+        'Ids': citations,
     })
 
     ai_chunks = chunks_used_by_ai(df,pages)
+    return pages, ai_chunks
+
+def request_deferred_reads(pages):
+    """On-demand trigger for deferred regions: the source pages shown (and highlighted) with an answer get read."""
+    if READ_DEFERRED_ON_ANSWER and pages:
+        job_ids = queue_deferred_reads(pages)
+        metrics.increment("query.deferred_reads", len(job_ids))
+        return job_ids
+    return []
+
+def retrieve_and_generate(question, doc_ids=None):
+    """Answer from every document, or only those in doc_ids.
+
+    Returns (answer, cited source keys such as "report/page_3", chunks used per source).
+    """
+    collection_version = get_collection_version()
+    cached = get_cached_answer(question, collection_version, doc_ids)
+    metrics.increment("query.answer_cache", result="hit" if cached is not None else "miss")
+    if cached is not None:
+        print("⚡ Answer served from cache")
+        return cached
+
+    with span("query.total"):
+        chunks, citations, extracted_citations, formatted_chunks = retrieve_context(question, doc_ids)
+        ai_response = generate_response(question, formatted_chunks, extracted_citations).replace("_"," ")
+        pages, ai_chunks = source_pages(ai_response, chunks, citations, extracted_citations)
+    request_deferred_reads(pages)
     
+    put_cached_answer(question, collection_version, (ai_response, pages, ai_chunks), doc_ids)
+    return ai_response, pages, ai_chunks
+
+def retrieve_and_generate_stream(question, doc_ids=None):
+    """Streaming retrieve_and_generate.
+
+    Yields answer text deltas as they arrive, then a final (answer, pages, ai_chunks) tuple
+    once the stream completes and source pages have been extracted.
+    """
+    collection_version = get_collection_version()
+    cached = get_cached_answer(question, collection_version, doc_ids)
+    metrics.increment("query.answer_cache", result="hit" if cached is not None else "miss")
+    if cached is not None:
+        print("⚡ Answer served from cache")
+        yield cached[0]
+        yield cached
+        return
+
+    t0 = time.perf_counter()
+    chunks, citations, extracted_citations, formatted_chunks = retrieve_context(question, doc_ids)
+    parts = []
+    for delta in generate_response_stream(question, formatted_chunks, extracted_citations):
+        if not parts:
+            print(f"⏱️ Time to first token: {time.perf_counter() - t0:.2f}s")
+            metrics.observe("query.first_token", time.perf_counter() - t0)
+        parts.append(delta)
+        yield delta
+
+    ai_response = "".join(parts).replace("_"," ")
+    pages, ai_chunks = source_pages(ai_response, chunks, citations, extracted_citations)
+    metrics.observe("query.total", time.perf_counter() - t0)
+    request_deferred_reads(pages)
+    put_cached_answer(question, collection_version, (ai_response, pages, ai_chunks), doc_ids)
+    yield ai_response, pages, ai_chunks
+
+
+# --- Async path (used by the HTTP API) ---
+async def embed_question_async(question):
+    embedding = await asyncio.to_thread(lookup_query_embedding, question, EMBEDDING_MODEL)
+    if embedding is None:
+        with span("query.embed"):
+            response = await get_async_client().embeddings.create(
+                input=normalize_question(question), model=EMBEDDING_MODEL
+            )
+        record_usage("embeddings", response.usage)
+        embedding = response.data[0].embedding
+        await asyncio.to_thread(store_query_embedding, question, EMBEDDING_MODEL, embedding)
+    return embedding
+
+async def query_documents_async(question, n_results=5, doc_ids=None, mode=None):
+    mode = mode or RETRIEVAL_MODE
+    embedding = None
+    if mode != "lexical":
+        try:
+            embedding = await embed_question_async(question)
+        except EMBEDDING_OUTAGE_ERRORS:
+            if mode == "vector":
+                raise
+            metrics.increment("query.lexical_fallbacks")
+            mode = "lexical"
+    return await asyncio.to_thread(search_documents, question, embedding, n_results, doc_ids, mode)
+
+async def generate_response_async(question, formatted_chucks, citations):
+    with span("query.generate", chunks=len(formatted_chucks)):
+        response = await get_async_client().chat.completions.create(
+            model=CHAT_MODEL,
+            messages=build_messages(question, formatted_chucks, citations),
+        )
+    record_usage("chat", response.usage)
+    return response.choices[0].message.content
+
+async def retrieve_and_generate_async(question, doc_ids=None):
+    collection_version = await asyncio.to_thread(get_collection_version)
+    cached = get_cached_answer(question, collection_version, doc_ids)
+    metrics.increment("query.answer_cache", result="hit" if cached is not None else "miss")
+    if cached is not None:
+        return cached
+
+    with span("query.total"):
+        chunks, citations = await query_documents_async(question, doc_ids=doc_ids)
+        extracted_citations = [chunk_source_key(citation) for citation in citations]
+        formatted_chunks = format_chunks(chunks, citations)
+        ai_response = (await generate_response_async(question, formatted_chunks, extracted_citations)).replace("_"," ")
+        pages, ai_chunks = source_pages(ai_response, chunks, citations, extracted_citations)
+    await asyncio.to_thread(request_deferred_reads, pages)
+
+    put_cached_answer(question, collection_version, (ai_response, pages, ai_chunks), doc_ids)
     return ai_response, pages, ai_chunks
 
 
@@ -160,8 +366,17 @@ def compute_precision_recall(retrieved_ids, ground_truth_ids):
     return precision, recall
 
 
-def evaluate_question(question, ground_truth_ids):
-    _, retrieved_ids = query_documents(question)
+def compute_mrr(retrieved_ids, ground_truth_ids):
+    """Reciprocal rank of the first relevant chunk (0 when none was retrieved)."""
+    ground_truth_set = set(ground_truth_ids)
+    for rank, chunk_id in enumerate(retrieved_ids, start=1):
+        if chunk_id in ground_truth_set:
+            return 1 / rank
+    return 0.0
+
+
+def evaluate_question(question, ground_truth_ids, doc_ids=None):
+    _, retrieved_ids = query_documents(question, doc_ids=doc_ids)
     precision, recall = compute_precision_recall(retrieved_ids, ground_truth_ids)
 
     print(f"🧠 Question: {question}")
@@ -169,4 +384,5 @@ def evaluate_question(question, ground_truth_ids):
     print(f"✅ Ground Truth: {ground_truth_ids}")
     print(f"📊 Precision: {precision:.2f}")
     print(f"📊 Recall: {recall:.2f}")
+    print(f"📊 MRR: {compute_mrr(retrieved_ids, ground_truth_ids):.2f}")
     return precision, recall
\ No newline at end of file
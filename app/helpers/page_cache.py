@@ -0,0 +1,187 @@
+import os
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+import pypdfium2
+from PIL import Image
+
+# Rendered pages are kept up to this many bytes of decoded pixels, least recently used evicted first
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# When set, evicted pages are written here (PNG or WEBP) and read back instead of re-rendering
+PAGE_CACHE_SPILL_DIR = os.getenv("PAGE_CACHE_SPILL_DIR")
+PAGE_CACHE_SPILL_FORMAT = os.getenv("PAGE_CACHE_SPILL_FORMAT", "PNG")
+MAX_OPEN_DOCUMENTS = int(os.getenv("MAX_OPEN_DOCUMENTS", 8))
+
+
+def image_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class DocumentKey(str):
+    """A document's cache key (hash of its bytes) that carries the PDF bytes, so an evicted document reopens."""
+
+    def __new__(cls, pdf_bytes):
+        key = super().__new__(cls, hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest())
+        key.pdf_bytes = pdf_bytes
+        return key
+
+
+class PageRasterCache:
+    """Shared page rasters keyed by (document hash, page, dpi).
+
+    Keeps one open pypdfium2 (and, on demand, PyMuPDF) handle per document, for at most
+    max_documents documents; a document evicted while a caller still holds its key is reopened
+    from the bytes the key carries. Returned images are shared between callers: copy them
+    before drawing on them.
+    """
+
+    def __init__(self, max_bytes=PAGE_CACHE_MAX_BYTES, spill_dir=PAGE_CACHE_SPILL_DIR,
+                 spill_format=PAGE_CACHE_SPILL_FORMAT, max_documents=MAX_OPEN_DOCUMENTS):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_format = spill_format.upper()
+        self.max_documents = max_documents
+        self.stats = {"hits": 0, "misses": 0, "disk_hits": 0, "evictions": 0, "spills": 0}
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._documents = OrderedDict()
+        self._fitz_documents = {}
+        self._keys_by_file = weakref.WeakKeyDictionary()
+        # pdfium is not thread-safe: rendering and handle management are serialized
+        self._lock = threading.RLock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    # --- Documents ---
+    def open_document(self, pdf):
+        """Register a PDF (bytes or file-like upload) and return its document key.
+
+        File objects are hashed once and remembered, so repeated lookups don't rehash the bytes.
+        """
+        key = None
+        if not isinstance(pdf, (bytes, bytearray)):
+            try:
+                key = self._keys_by_file.get(pdf)
+            except TypeError:
+                pass
+        if key is None:
+            key = DocumentKey(bytes(pdf) if isinstance(pdf, (bytes, bytearray)) else pdf.getvalue())
+            try:
+                self._keys_by_file[pdf] = key
+            except TypeError:
+                pass
+        with self._lock:
+            self._document(key)
+        return key
+
+    def _document(self, key):
+        """The pdfium handle of key (lock held), reopened if it was evicted."""
+        if key in self._documents:
+            self._documents.move_to_end(key)
+            return self._documents[key]
+        self._documents[key] = pypdfium2.PdfDocument(key.pdf_bytes)
+        while len(self._documents) > self.max_documents:
+            self.close_document(next(iter(self._documents)))
+        return self._documents[key]
+
+    def close_document(self, key):
+        with self._lock:
+            doc = self._documents.pop(key, None)
+            if doc is not None:
+                doc.close()
+            fitz_doc = self._fitz_documents.pop(key, None)
+            if fitz_doc is not None:
+                fitz_doc.close()
+
+    def page_count(self, pdf):
+        key = self.open_document(pdf)
+        with self._lock:
+            return len(self._document(key))
+
+    def search_text(self, pdf, page_num, texts):
+        """PyMuPDF search of page page_num for each text: matching rectangles (x0, y0, x1, y1) in PDF points.
+
+        The PyMuPDF handle is shared and not thread-safe, so the search runs under the cache lock.
+        """
+        import fitz  # PyMuPDF, only needed for highlighting
+        key = self.open_document(pdf)
+        with self._lock:
+            self._document(key)
+            if key not in self._fitz_documents:
+                self._fitz_documents[key] = fitz.open(stream=key.pdf_bytes, filetype="pdf")
+            page = self._fitz_documents[key][page_num - 1]
+            return [tuple(rect) for text in texts for rect in page.search_for(text)]
+
+    def text_regions(self, key, page_num, polys, image_width):
+        """Text-layer text of page page_num inside each pixel polygon of a render image_width wide (None: use OCR)."""
+        from app.helpers.text_layer import region_texts
+        with self._lock:
+            return region_texts(self._document(key)[page_num - 1], polys, image_width)
+
+    # --- Pages ---
+    def get_page(self, pdf, page_num, dpi):
+        """Return page page_num (1-based) of pdf rendered at dpi as an RGB PIL image."""
+        return self.render(self.open_document(pdf), page_num, dpi)
+
+    def render(self, key, page_num, dpi):
+        # A plain str: cached images must not keep the document's bytes alive
+        cache_key = (str(key), page_num, dpi)
+        with self._lock:
+            image = self._images.get(cache_key)
+            if image is not None:
+                self._images.move_to_end(cache_key)
+                self.stats["hits"] += 1
+                return image
+            self.stats["misses"] += 1
+            image = self._load_spilled(cache_key)
+            if image is None:
+                image = self._document(key)[page_num - 1].render(scale=dpi / 72).to_pil().convert("RGB")
+            self._store(cache_key, image)
+            return image
+
+    def _store(self, cache_key, image):
+        nbytes = image_nbytes(image)
+        if nbytes > self.max_bytes:
+            return
+        self._images[cache_key] = image
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes:
+            old_key, old_image = self._images.popitem(last=False)
+            self._bytes -= image_nbytes(old_image)
+            self.stats["evictions"] += 1
+            self._spill(old_key, old_image)
+
+    # --- Disk spill ---
+    def _spill_path(self, cache_key):
+        key, page_num, dpi = cache_key
+        return os.path.join(self.spill_dir, f"{key}_{page_num}_{dpi}.{self.spill_format.lower()}")
+
+    def _spill(self, cache_key, image):
+        if not self.spill_dir:
+            return
+        path = self._spill_path(cache_key)
+        if not os.path.exists(path):
+            options = {"lossless": True} if self.spill_format == "WEBP" else {}
+            image.save(path, format=self.spill_format, **options)
+            self.stats["spills"] += 1
+
+    def _load_spilled(self, cache_key):
+        if not self.spill_dir:
+            return None
+        path = self._spill_path(cache_key)
+        if not os.path.exists(path):
+            return None
+        self.stats["disk_hits"] += 1
+        with Image.open(path) as image:
+            return image.convert("RGB")
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+            for key in list(self._documents):
+                self.close_document(key)
+
+
+page_cache = PageRasterCache()
@@ -0,0 +1,238 @@
+import os
+import time
+import queue
+import threading
+
+from app.helpers.layout_analysis import (
+    predict_layout, PIPELINE_VERSION, IMAGE_DPI_HIGHRES, LAYOUT_BATCH_SIZE, page_fingerprint, prediction_polys_labels,
+    ocr_pages, remove_page_files, page_text_path,
+)
+from app.helpers.chunking import build_chunks
+from app.helpers.embeddings import embed_texts_cached, save_chunks_to_sqlite
+from app.helpers.vector_store import get_vector_store
+from app.helpers.db import delete_layout_analysis_pages, upsert_page_fingerprints, bump_collection_version
+from app.helpers.page_cache import page_cache
+from app.helpers.ocr import ocr_timing_summary
+from app.helpers.documents import DEFAULT_DOCUMENT, document_text_dir
+from app.helpers.metrics import metrics, span, profiled, log_event
+
+# Pages buffered between two stages; a full queue blocks the upstream stage (backpressure)
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 4))
+OCR_PAGES_PER_BATCH = int(os.getenv("OCR_PAGES_PER_BATCH", 2))
+EMBED_PAGES_PER_BATCH = int(os.getenv("EMBED_PAGES_PER_BATCH", 8))
+
+STAGES = ["render", "layout", "ocr", "embed", "upsert"]
+_DONE = object()
+
+
+class PipelineCancelled(Exception):
+    pass
+
+
+def run_ingest_pipeline(pdf_file, page_count, previous_fingerprints=None, on_progress=None,
+                        should_stop=None, dpi=IMAGE_DPI_HIGHRES, doc_id=DEFAULT_DOCUMENT):
+    """Ingest a PDF (upload or bytes) through overlapping render -> layout -> OCR -> chunk/embed -> upsert stages.
+
+    Everything written (layout rows, chunks, vectors, fingerprints) is scoped to doc_id, so
+    several documents can be ingested concurrently and independently.
+
+    Each stage runs in its own thread and hands pages downstream through bounded queues, so
+    early pages are embedded and queryable while later pages are still in layout/OCR. Pages
+    whose fingerprint matches previous_fingerprints are skipped. on_progress is called from
+    the calling thread with per-stage page counts; when should_stop() returns True the stages
+    are stopped after their current batch and PipelineCancelled is raised. Pages already
+    upserted keep their fingerprints, so a later incremental run resumes after them.
+    Returns the final counts.
+
+    Every stage batch is timed into the process metrics and logged as a span (see
+    app.helpers.metrics); with PROFILE_INGEST set each stage thread is profiled separately.
+    """
+    previous_fingerprints = previous_fingerprints or {}
+    queues = {stage: queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for stage in STAGES[1:]}
+    progress = {stage: 0 for stage in STAGES}
+    progress.update({"skipped": 0, "total": page_count})
+    # Pages read entirely from the PDF text layer, entirely by OCR, or both
+    progress.update({"text_layer_pages": 0, "ocr_pages": 0, "mixed_pages": 0, "deferred_regions": 0,
+                     "skipped_regions": 0})
+    # Time spent in the layout predictor, for the pages/s throughput of batched inference
+    progress["layout_seconds"] = 0.0
+    # This run's per-region OCR times; concurrent runs for other documents keep their own
+    ocr_timings = []
+    stop = threading.Event()
+    errors = []
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get_batch(q, max_items):
+        """Block for one item, then drain whatever else is ready; returns (items, upstream_done)."""
+        while not stop.is_set():
+            try:
+                first = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        else:
+            return [], True
+        if first is _DONE:
+            return [], True
+        items = [first]
+        while len(items) < max_items:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return items, True
+            items.append(item)
+        return items, False
+
+    key = page_cache.open_document(pdf_file)
+
+    def render(out):
+        for i in range(page_count):
+            if stop.is_set():
+                return
+            with span("ingest.render", doc_id=doc_id, page=i + 1) as extra:
+                image = page_cache.render(key, i + 1, dpi)
+                fingerprint = page_fingerprint(image, dpi)
+                extra["unchanged"] = previous_fingerprints.get(f"page_{i+1}") == fingerprint
+            progress["render"] += 1
+            if extra["unchanged"]:
+                progress["skipped"] += 1
+                metrics.increment("ingest.pages_skipped")
+                continue
+            put(out, (i + 1, image, fingerprint))
+
+    def layout(out):
+        done = False
+        while not done:
+            batch, done = get_batch(queues["layout"], LAYOUT_BATCH_SIZE)
+            if not batch:
+                continue
+            pages = [n for n, _, _ in batch]
+            t_batch = time.perf_counter()
+            preds = predict_layout([img for _, img, _ in batch], doc_id=doc_id, pages=pages)
+            seconds = time.perf_counter() - t_batch
+            progress["layout_seconds"] += seconds
+            metrics.increment("layout.pages", len(batch))
+            print(f"📐 Layout batch ({doc_id}) pages {pages[0]}-{pages[-1]}: {seconds:.2f}s "
+                  f"({len(batch) / max(seconds, 1e-9):.2f} pages/s)")
+            for (page_number, img, fingerprint), pred in zip(batch, preds):
+                polys, labels = prediction_polys_labels(pred)
+                put(out, (page_number, img, fingerprint, polys, labels))
+            progress["layout"] += len(batch)
+
+    def ocr(out):
+        done = False
+        while not done:
+            batch, done = get_batch(queues["ocr"], OCR_PAGES_PER_BATCH)
+            if not batch:
+                continue
+            if previous_fingerprints:
+                with span("ingest.clear_pages", doc_id=doc_id, pages=[n for n, *_ in batch]):
+                    for page_number, *_ in batch:
+                        remove_page_files(page_number, document_text_dir(doc_id))
+                    delete_layout_analysis_pages([f"page_{n}" for n, *_ in batch], doc_id)
+            pages = ocr_pages([(polys, img, labels, n) for n, img, _, polys, labels in batch], doc_id, pdf_key=key,
+                              timings=ocr_timings)
+            for (_, _, fingerprint, polys, _), page in zip(batch, pages):
+                path = page_text_path(page)
+                if f"{path}_pages" in progress:
+                    progress[f"{path}_pages"] += 1
+                progress["deferred_regions"] += page.count("deferred")
+                progress["skipped_regions"] += len(polys) - len(page.blocks)
+                # Pages go to chunking in memory, in page order
+                put(out, (fingerprint, page))
+            progress["ocr"] += len(batch)
+
+    def embed(out):
+        done = False
+        while not done:
+            batch, done = get_batch(queues["embed"], EMBED_PAGES_PER_BATCH)
+            if not batch:
+                continue
+            chunked_documents = []
+            with span("ingest.chunk", doc_id=doc_id, pages=[page.number for _, page in batch]) as extra:
+                for _, page in batch:
+                    chunked_documents.extend(build_chunks(page))
+                extra["chunks"] = len(chunked_documents)
+            if chunked_documents:
+                with span("ingest.embed", doc_id=doc_id, chunks=len(chunked_documents)):
+                    embeddings = embed_texts_cached([doc["text"] for doc in chunked_documents])
+                for doc, embedding in zip(chunked_documents, embeddings):
+                    doc["embedding"] = embedding
+            fingerprints = {page.label: fingerprint for fingerprint, page in batch}
+            put(out, (fingerprints, chunked_documents))
+            progress["embed"] += len(batch)
+
+    def upsert(out):
+        store = get_vector_store()
+        done = False
+        while not done:
+            batch, done = get_batch(queues["upsert"], PIPELINE_QUEUE_SIZE)
+            for fingerprints, chunked_documents in batch:
+                pages = list(fingerprints)
+                with span("ingest.save_chunks", doc_id=doc_id, pages=pages, chunks=len(chunked_documents)):
+                    save_chunks_to_sqlite(chunked_documents, replace_pages=pages, doc_id=doc_id)
+                with span("ingest.upsert_vectors", doc_id=doc_id, pages=pages, chunks=len(chunked_documents)):
+                    store.delete_pages(pages, doc_id)
+                    store.upsert(chunked_documents)
+                bump_collection_version()
+                # Recorded last: a page only counts as ingested once it is queryable
+                upsert_page_fingerprints(fingerprints, PIPELINE_VERSION, doc_id)
+                progress["upsert"] += len(pages)
+                metrics.increment("ingest.pages", len(pages))
+
+    def run_stage(name, fn, out):
+        try:
+            with profiled(f"{doc_id}-{run_id}-{name}"):
+                fn(out)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            if out is not None:
+                put(out, _DONE)
+
+    outputs = [queues["layout"], queues["ocr"], queues["embed"], queues["upsert"], None]
+    threads = [
+        threading.Thread(target=run_stage, args=(name, fn, out), name=f"ingest-{name}", daemon=True)
+        for name, fn, out in zip(STAGES, [render, layout, ocr, embed, upsert], outputs)
+    ]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    cancelled = False
+    while any(t.is_alive() for t in threads):
+        if on_progress:
+            on_progress(dict(progress))
+        if should_stop and not cancelled and should_stop():
+            cancelled = True
+            stop.set()
+        time.sleep(0.25)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    if cancelled:
+        raise PipelineCancelled(f"Ingestion cancelled after {progress['upsert']} pages")
+
+    progress["seconds"] = time.perf_counter() - t0
+    progress["ocr_timings"] = ocr_timing_summary(ocr_timings)
+    metrics.observe("ingest.run", progress["seconds"])
+    log_event("ingest.run", doc_id=doc_id, **progress)
+    if on_progress:
+        on_progress(dict(progress))
+    print(f"🚰 Ingest pipeline ({doc_id}): {progress['upsert']} pages ingested, {progress['skipped']} unchanged, "
+          f"{progress['seconds']:.1f}s (text layer {progress['text_layer_pages']}, OCR {progress['ocr_pages']}, "
+          f"mixed {progress['mixed_pages']}; regions deferred {progress['deferred_regions']}, "
+          f"skipped {progress['skipped_regions']}; layout "
+          f"{progress['layout'] / max(progress['layout_seconds'], 1e-9):.2f} pages/s)")
+    return progress
@@ -0,0 +1,103 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+
+from app.helpers.embedding_cache import get_cached_embeddings, put_cached_embeddings
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 512))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", 3600))
+
+
+def normalize_question(question):
+    """Case, whitespace and trailing punctuation don't change the question."""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ttl seconds."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+answer_cache = TTLCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS)
+_answer_cache_version = None
+
+
+# --- Level 1: query embeddings ---
+def lookup_query_embedding(question, model):
+    return get_cached_embeddings([normalize_question(question)], model)[0]
+
+
+def store_query_embedding(question, model, embedding):
+    put_cached_embeddings([normalize_question(question)], [embedding], model)
+
+
+def cached_query_embedding(question, model, embed_fn):
+    """Embedding of the normalized question, persisted in the embedding cache table."""
+    embedding = lookup_query_embedding(question, model)
+    if embedding is None:
+        embedding = embed_fn(normalize_question(question))
+        store_query_embedding(question, model, embedding)
+    return embedding
+
+
+# --- Level 2: answers ---
+def _sync_version(collection_version):
+    # A re-ingested document invalidates every cached answer
+    global _answer_cache_version
+    if collection_version != _answer_cache_version:
+        answer_cache.clear()
+        _answer_cache_version = collection_version
+
+
+def _answer_key(question, collection_version, doc_ids):
+    # The same question over a different document selection is a different answer
+    return normalize_question(question), collection_version, tuple(sorted(doc_ids)) if doc_ids else None
+
+
+def get_cached_answer(question, collection_version, doc_ids=None):
+    _sync_version(collection_version)
+    return answer_cache.get(_answer_key(question, collection_version, doc_ids))
+
+
+def put_cached_answer(question, collection_version, result, doc_ids=None):
+    _sync_version(collection_version)
+    answer_cache.put(_answer_key(question, collection_version, doc_ids), result)
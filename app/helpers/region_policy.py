@@ -0,0 +1,82 @@
+import os
+import json
+
+from app.helpers.chunking import is_content_label
+
+# What ingestion does with each Surya region, keyed on its label ("Table-4-0.91" -> Table, confidence 0.91):
+#   "ocr"   read its text now (text layer, else Tesseract)
+#   "defer" store the region without text; ocr_deferred_regions() reads it on demand
+#   "skip"  drop it
+# Labels chunking throws away (headers, footers, pictures, figures) are skipped unless a rule says otherwise.
+OCR, DEFER, SKIP = "ocr", "defer", "skip"
+ACTIONS = (OCR, DEFER, SKIP)
+
+DEFAULT_RULE = {
+    "action": OCR,
+    # Regions less confident than this get low_confidence_action instead
+    "min_confidence": 0.0,
+    "low_confidence_action": DEFER,
+    # Write the upscaled crop PNG to data/<doc>/individual_pages/page_N/text_images
+    "save_crop": os.getenv("SAVE_REGION_CROPS", "0") == "1",
+}
+DEFAULT_RULES = {
+    # Slow to OCR and rarely needed: read on demand (when an answer cites the page), then chunked
+    "Table": {"action": DEFER},
+}
+# JSON object (or path to a JSON file) of per-label rules merged over the defaults,
+# e.g. {"Table": {"action": "ocr"}, "Text": {"min_confidence": 0.5}, "default": {"save_crop": true}}
+REGION_POLICY = os.getenv("REGION_POLICY")
+
+
+def normalize_label(name):
+    return name.lower().replace("-", "").replace("_", "")
+
+
+def parse_label(label):
+    """'SectionHeader-3-0.97' -> ('SectionHeader', 0.97); labels without a confidence count as certain."""
+    try:
+        name, _, confidence = label.rsplit("-", 2)
+        return name, float(confidence)
+    except ValueError:
+        return label, 1.0
+
+
+class RegionPolicy:
+    def __init__(self, rules=None):
+        rules = {**DEFAULT_RULES, **(rules or {})}
+        self.default = {**DEFAULT_RULE, **rules.pop("default", {})}
+        self.rules = {normalize_label(name): {**self.default, **rule} for name, rule in rules.items()}
+        for rule in [self.default, *self.rules.values()]:
+            for key in ("action", "low_confidence_action"):
+                if rule[key] not in ACTIONS:
+                    raise ValueError(f"Unknown region action {rule[key]!r}, expected one of {ACTIONS}")
+
+    def rule(self, name):
+        rule = self.rules.get(normalize_label(name))
+        if rule is not None:
+            return rule
+        return self.default if is_content_label(name) else {**self.default, "action": SKIP}
+
+    def decide(self, label):
+        """(action, save_crop) for one region label."""
+        name, confidence = parse_label(label)
+        rule = self.rule(name)
+        action = rule["action"]
+        if action == OCR and confidence < rule["min_confidence"]:
+            action = rule["low_confidence_action"]
+        return action, rule["save_crop"]
+
+    def plan(self, labels):
+        return [self.decide(label) for label in labels]
+
+
+def load_region_policy(spec=REGION_POLICY):
+    if not spec:
+        return RegionPolicy()
+    if os.path.exists(spec):
+        with open(spec, "r", encoding="utf-8") as f:
+            return RegionPolicy(json.load(f))
+    return RegionPolicy(json.loads(spec))
+
+
+region_policy = load_region_policy()
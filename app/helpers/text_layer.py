@@ -0,0 +1,61 @@
+import os
+import unicodedata
+
+# Born-digital PDFs carry an exact text layer: regions read from it skip crop/upscale/Tesseract.
+# Regions with no text-layer text (scans) or garbled text (fonts without a usable ToUnicode map) are OCR'd.
+TEXT_LAYER = os.getenv("TEXT_LAYER", "1") == "1"
+# Share of non-space characters that may be undecodable (U+FFFD, control, private use) before falling back to OCR
+TEXT_LAYER_MAX_GARBLED = float(os.getenv("TEXT_LAYER_MAX_GARBLED", 0.05))
+# Minimum share of letters/digits among non-space characters; symbol soup means a broken font encoding
+TEXT_LAYER_MIN_ALNUM = float(os.getenv("TEXT_LAYER_MIN_ALNUM", 0.5))
+# Points added around each region: Surya boxes can clip glyph edges
+TEXT_LAYER_PADDING = 1.0
+
+BAD_CATEGORIES = ("Cc", "Co", "Cs", "Cn")
+
+
+def looks_garbled(text):
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return True
+    bad = sum(1 for c in chars if c == "\ufffd" or unicodedata.category(c) in BAD_CATEGORIES)
+    if bad / len(chars) > TEXT_LAYER_MAX_GARBLED:
+        return True
+    return sum(1 for c in chars if c.isalnum()) / len(chars) < TEXT_LAYER_MIN_ALNUM
+
+
+def clean_text(text):
+    return text.replace("\r\n", "\n").replace("\r", "\n").replace("\x02", "").strip()
+
+
+def poly_to_pdf_rect(poly, scale, crop_left, crop_top, padding=TEXT_LAYER_PADDING):
+    """Pixel polygon of a page rendered at `scale` pixels per point -> PDF (left, bottom, right, top)."""
+    xs, ys = [p[0] for p in poly], [p[1] for p in poly]
+    return (
+        crop_left + min(xs) / scale - padding,
+        crop_top - max(ys) / scale - padding,
+        crop_left + max(xs) / scale + padding,
+        crop_top - min(ys) / scale + padding,
+    )
+
+
+def region_texts(pdf_page, polys, image_width):
+    """Text-layer text inside each region of a pypdfium2 page rendered image_width pixels wide.
+
+    Returns None for the whole page when it has no text layer, or is rotated (pixel and
+    text-layer coordinates would not line up), so every region goes to OCR.
+    """
+    if pdf_page.get_rotation():
+        return None
+    textpage = pdf_page.get_textpage()
+    try:
+        if textpage.count_chars() == 0:
+            return None
+        crop_left, _, crop_right, crop_top = pdf_page.get_cropbox()
+        scale = image_width / (crop_right - crop_left)
+        return [
+            clean_text(textpage.get_text_bounded(*poly_to_pdf_rect(poly, scale, crop_left, crop_top)))
+            for poly in polys
+        ]
+    finally:
+        textpage.close()
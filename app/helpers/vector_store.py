@@ -0,0 +1,481 @@
+import os
+import json
+import fcntl
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import numpy as np
+from dotenv import load_dotenv
+
+from app.helpers.documents import DEFAULT_DOCUMENT, chunk_source_key, parse_source_key
+
+load_dotenv()
+openai_key = os.getenv("OPENAI_API_KEY")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+# "chroma" (persistent Chroma collection) or "numpy" (in-process memory-mapped float32 index)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+CHROMA_PATH = "./data/chroma_persistent_storage"
+COLLECTION_NAME = "document_qa_collection"
+CHROMA_UPSERT_BATCH = int(os.getenv("CHROMA_UPSERT_BATCH", 1000))
+NUMPY_INDEX_PATH = os.getenv("NUMPY_INDEX_PATH", "./data/vector_index")
+# The numpy backend switches from exact search to an IVF index above this many vectors
+IVF_MIN_VECTORS = int(os.getenv("IVF_MIN_VECTORS", 20000))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", 8))
+
+
+def chunk_id_page(chunk_id):
+    # "report/page_3.md_chunk2" -> "page_3"
+    return f"page_{parse_source_key(chunk_source_key(chunk_id))[1]}"
+
+
+def chunk_id_document(chunk_id):
+    # "report/page_3.md_chunk2" -> "report"
+    return parse_source_key(chunk_source_key(chunk_id))[0]
+
+
+class VectorStore(ABC):
+    """Retrieval backend used by ingestion (upsert/delete) and query_documents (query)."""
+
+    @abstractmethod
+    def reset(self):
+        pass
+
+    @abstractmethod
+    def upsert(self, chunked_documents):
+        """Insert or replace chunk dicts with id, text and embedding."""
+
+    @abstractmethod
+    def delete_pages(self, pages, doc_id=DEFAULT_DOCUMENT):
+        pass
+
+    @abstractmethod
+    def delete_document(self, doc_id):
+        pass
+
+    @abstractmethod
+    def query(self, query_embedding, n_results=5, doc_ids=None):
+        """Return (documents, ids) of the n_results nearest chunks, best first, optionally only from doc_ids."""
+
+    @abstractmethod
+    def count(self):
+        pass
+
+    def reopen(self):
+        """Drop in-memory state so the next call reads the store from disk again."""
+
+
+class ChromaVectorStore(VectorStore):
+    def __init__(self, path=CHROMA_PATH, collection_name=COLLECTION_NAME):
+        self.path = path
+        self.collection_name = collection_name
+        self._client = None
+        self._collection = None
+        self._lock = threading.RLock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import chromadb
+                self._client = chromadb.PersistentClient(path=self.path)
+            return self._client
+
+    @property
+    def collection(self):
+        with self._lock:
+            if self._collection is None:
+                from chromadb.utils import embedding_functions
+                openai_ef = embedding_functions.OpenAIEmbeddingFunction(
+                    api_key=openai_key, model_name=EMBEDDING_MODEL,
+                )
+                self._collection = self.client.get_or_create_collection(
+                    name=self.collection_name, embedding_function=openai_ef
+                )
+            return self._collection
+
+    def reopen(self):
+        with self._lock:
+            if self._client is not None:
+                # PersistentClient shares one in-memory system (and HNSW index) per path. Unregister it so the
+                # next client starts a fresh one that re-reads the disk, but don't stop it: queries running
+                # on other threads keep the old collection until they finish.
+                from chromadb.api.client import SharedSystemClient
+                for name in ("_identifier_to_system", "_identifer_to_system"):  # renamed across chromadb versions
+                    getattr(SharedSystemClient, name, {}).pop(self._client._identifier, None)
+            self._client, self._collection = None, None
+
+    def clear_folders(self):
+        for item in os.listdir(self.path):
+            item_path = os.path.join(self.path, item)
+            # Delete folders only, keep files (like chroma.sqlite3)
+            if os.path.isdir(item_path):
+                shutil.rmtree(item_path)
+
+    def reset(self):
+        self.clear_folders()
+        # Delete old collection (if it exists)
+        try:
+            self.client.delete_collection(name=self.collection_name)
+            print("✅ Deleted previous collection.")
+        except Exception as e:
+            print(f"⚠️ Could not delete collection: {e}")
+        self._collection = None
+
+    def upsert(self, chunked_documents):
+        for start in range(0, len(chunked_documents), CHROMA_UPSERT_BATCH):
+            batch = chunked_documents[start:start + CHROMA_UPSERT_BATCH]
+            self.collection.upsert(
+                ids=[doc["id"] for doc in batch],
+                documents=[doc["text"] for doc in batch],
+                embeddings=[doc["embedding"] for doc in batch],
+                metadatas=[{"doc_id": chunk_id_document(doc["id"]), "page": chunk_id_page(doc["id"])} for doc in batch]
+            )
+
+    def delete_pages(self, pages, doc_id=DEFAULT_DOCUMENT):
+        if pages:
+            self.collection.delete(where={"$and": [{"doc_id": doc_id}, {"page": {"$in": list(pages)}}]})
+
+    def delete_document(self, doc_id):
+        self.collection.delete(where={"doc_id": doc_id})
+
+    def query(self, query_embedding, n_results=5, doc_ids=None):
+        where = {"doc_id": {"$in": list(doc_ids)}} if doc_ids else None
+        results = self.collection.query(query_embeddings=[query_embedding], n_results=n_results, where=where)
+        return results["documents"][0], results["ids"][0]
+
+    def count(self):
+        return self.collection.count()
+
+
+class NumpyVectorStore(VectorStore):
+    """Normalized float32 vectors in an append-only memory-mapped file.
+
+    vectors-<generation>.f32 holds one row per chunk and texts-<generation>.jsonl one JSON string
+    per row; index.json holds ids, document ids, a live flag per row and how much of each file is
+    committed. Rows are appended before index.json is atomically replaced, so a crash in between
+    only leaves an uncommitted tail that the next append truncates. Writers hold an exclusive
+    lock on <path>.lock and first reload index.json if another process replaced it, so a stale
+    handle never truncates or overwrites rows it has not seen. Upserts and deletes tombstone
+    old rows; once half of the rows are dead the live ones are written to a new generation of
+    files, which readers (whose memory maps keep the old files open) never see change under them.
+    Search is an exact dot product with argpartition top-k, or an IVF (k-means) index probed
+    over IVF_NPROBE lists once the store holds IVF_MIN_VECTORS vectors. Writers train the IVF
+    centroids once per generation (ivf-<generation>.npy) and append each new row's list to
+    ivf-<generation>.i32, so readers only load them.
+    """
+
+    def __init__(self, path=NUMPY_INDEX_PATH):
+        self.path = path
+        self.meta_path = os.path.join(path, "index.json")
+        self.lock_path = os.path.normpath(path) + ".lock"
+        self._lock = threading.RLock()
+        self._meta = None
+        self._meta_stat = None
+        self._texts = None
+        self._vectors = None
+        self._ivf = None
+        self._obsolete = []
+
+    # --- Storage ---
+    def _files(self, generation):
+        if generation is None:
+            # Indexes written before generations: vectors.f32, texts inside index.json
+            return os.path.join(self.path, "vectors.f32"), None
+        return (os.path.join(self.path, f"vectors-{generation}.f32"),
+                os.path.join(self.path, f"texts-{generation}.jsonl"))
+
+    def _ivf_files(self, generation):
+        return (os.path.join(self.path, f"ivf-{generation}.npy"),
+                os.path.join(self.path, f"ivf-{generation}.i32"))
+
+    def _stat_meta(self):
+        try:
+            stat = os.stat(self.meta_path)
+        except FileNotFoundError:
+            return None
+        # index.json is only ever replaced, so a new inode means another writer committed
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @contextmanager
+    def _writing(self):
+        """Exclusive write access across threads and processes, on an up-to-date copy of index.json."""
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.lock_path)), exist_ok=True)
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if self._meta is not None and self._stat_meta() != self._meta_stat:
+                        self.reopen()
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_meta(self):
+        if self._meta is None:
+            self._meta_stat = self._stat_meta()
+            if os.path.exists(self.meta_path):
+                with open(self.meta_path, "r", encoding="utf-8") as f:
+                    self._meta = json.load(f)
+            else:
+                self._meta = {"dim": None, "ids": [], "docs": [], "live": [], "generation": 0, "texts_bytes": 0,
+                              "ivf_rows": 0}
+            # Indexes written before multi-document support
+            self._meta.setdefault("docs", [chunk_id_document(chunk_id) for chunk_id in self._meta["ids"]])
+            # Rows assigned to an IVF list; 0 while the store has no IVF index
+            self._meta.setdefault("ivf_rows", 0)
+            if "texts" in self._meta:
+                self._texts = self._meta.pop("texts")
+                self._meta.update(generation=None, texts_bytes=0)
+        return self._meta
+
+    def _load_texts(self):
+        meta = self._load_meta()
+        if self._texts is None:
+            self._texts = []
+            if meta["texts_bytes"]:
+                with open(self._files(meta["generation"])[1], "rb") as f:
+                    self._texts = [json.loads(line) for line in f.read(meta["texts_bytes"]).splitlines()]
+        return self._texts
+
+    def _save_meta(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._meta, f)
+        os.replace(tmp_path, self.meta_path)
+        self._meta_stat = self._stat_meta()
+        # Files of the previous generation; open memory maps keep their data until closed
+        for path in self._obsolete:
+            if os.path.exists(path):
+                os.remove(path)
+        self._obsolete = []
+        self._vectors = None
+        self._ivf = None
+
+    def _matrix(self):
+        meta = self._load_meta()
+        if self._vectors is None and meta["ids"]:
+            self._vectors = np.memmap(self._files(meta["generation"])[0], dtype=np.float32, mode="r",
+                                      shape=(len(meta["ids"]), meta["dim"]))
+        return self._vectors
+
+    @staticmethod
+    def _append(path, committed, data):
+        """Write data after the first committed bytes of path, dropping a tail left by an interrupted write."""
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.truncate(committed)
+            f.seek(committed)
+            f.write(data)
+
+    @staticmethod
+    def _encode_texts(texts):
+        # json.dumps escapes newlines, so each text is exactly one line
+        return "".join(json.dumps(text) + "\n" for text in texts).encode("utf-8")
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _tombstone(self, predicate):
+        meta = self._load_meta()
+        for row, chunk_id in enumerate(meta["ids"]):
+            if meta["live"][row] and predicate(chunk_id):
+                meta["live"][row] = False
+
+    def _compact(self, force=False):
+        """Write the live rows to the next generation of files; index.json switches over in _save_meta()."""
+        meta = self._load_meta()
+        live_rows = [row for row, live in enumerate(meta["live"]) if live]
+        if not force and len(live_rows) * 2 >= len(meta["live"]):
+            return
+        texts = self._load_texts()
+        kept = np.array(self._matrix()[live_rows]) if live_rows else np.zeros((0, meta["dim"] or 0), np.float32)
+        kept_texts = [texts[row] for row in live_rows]
+        generation = (meta["generation"] or 0) + 1
+        vectors_path, texts_path = self._files(generation)
+        os.makedirs(self.path, exist_ok=True)
+        kept.tofile(vectors_path)
+        encoded = self._encode_texts(kept_texts)
+        with open(texts_path, "wb") as f:
+            f.write(encoded)
+        self._obsolete.extend(path for path in self._files(meta["generation"]) if path)
+        if meta["ivf_rows"]:
+            self._obsolete.extend(self._ivf_files(meta["generation"]))
+        self._vectors = None
+        self._texts = kept_texts
+        meta["ids"] = [meta["ids"][row] for row in live_rows]
+        meta["docs"] = [meta["docs"][row] for row in live_rows]
+        meta["live"] = [True] * len(live_rows)
+        meta.update(generation=generation, texts_bytes=len(encoded), ivf_rows=0)
+
+    def _update_ivf(self):
+        """Assign rows appended since the last write to IVF lists, training the centroids first if needed."""
+        meta = self._load_meta()
+        if not meta["ivf_rows"] and sum(meta["live"]) < IVF_MIN_VECTORS:
+            return
+        centroids_path, lists_path = self._ivf_files(meta["generation"])
+        matrix = self._matrix()
+        if not meta["ivf_rows"]:
+            centroids = self._train_ivf(matrix, np.flatnonzero(meta["live"]))
+            np.save(centroids_path, centroids)
+        else:
+            centroids = np.load(centroids_path)
+        rows = np.arange(meta["ivf_rows"], len(meta["ids"]))
+        self._append(lists_path, meta["ivf_rows"] * 4, self._assign_ivf(matrix, rows, centroids).tobytes())
+        meta["ivf_rows"] = len(meta["ids"])
+
+    def reset(self):
+        with self._writing():
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.reopen()
+
+    def reopen(self):
+        with self._lock:
+            self._meta, self._texts, self._vectors, self._ivf = None, None, None, None
+            self._meta_stat = None
+
+    def upsert(self, chunked_documents):
+        if not chunked_documents:
+            return
+        with self._writing():
+            meta = self._load_meta()
+            vectors = self._normalize([doc["embedding"] for doc in chunked_documents])
+            if meta["dim"] is None:
+                meta["dim"] = vectors.shape[1]
+            elif vectors.shape[1] != meta["dim"]:
+                raise ValueError(f"Embeddings have {vectors.shape[1]} dimensions, the index holds {meta['dim']}; "
+                                 "reset the vector store after changing EMBEDDING_MODEL")
+            new_ids = {doc["id"] for doc in chunked_documents}
+            self._tombstone(lambda chunk_id: chunk_id in new_ids)
+            if meta["generation"] is None:
+                self._compact(force=True)
+            vectors_path, texts_path = self._files(meta["generation"])
+            os.makedirs(self.path, exist_ok=True)
+            self._vectors = None
+            self._append(vectors_path, len(meta["ids"]) * meta["dim"] * 4, vectors.tobytes())
+            encoded = self._encode_texts(doc["text"] for doc in chunked_documents)
+            self._append(texts_path, meta["texts_bytes"], encoded)
+            meta["texts_bytes"] += len(encoded)
+            meta["ids"].extend(doc["id"] for doc in chunked_documents)
+            if self._texts is not None:
+                self._texts.extend(doc["text"] for doc in chunked_documents)
+            meta["docs"].extend(chunk_id_document(doc["id"]) for doc in chunked_documents)
+            meta["live"].extend([True] * len(chunked_documents))
+            self._compact()
+            self._update_ivf()
+            self._save_meta()
+
+    def delete_pages(self, pages, doc_id=DEFAULT_DOCUMENT):
+        if not pages:
+            return
+        with self._writing():
+            keys = {f"{doc_id}/{page}" for page in pages}
+            self._tombstone(lambda chunk_id: chunk_source_key(chunk_id) in keys)
+            self._compact(force=self._load_meta()["generation"] is None)
+            self._update_ivf()
+            self._save_meta()
+
+    def delete_document(self, doc_id):
+        with self._writing():
+            self._tombstone(lambda chunk_id: chunk_id_document(chunk_id) == doc_id)
+            self._compact(force=self._load_meta()["generation"] is None)
+            self._update_ivf()
+            self._save_meta()
+
+    def count(self):
+        with self._lock:
+            return sum(self._load_meta()["live"])
+
+    # --- Search ---
+    def _train_ivf(self, matrix, rows):
+        """k-means coarse quantizer over a sample of rows: (nlist, dim) normalized centroids."""
+        nlist = max(1, int(np.sqrt(len(rows))))
+        rng = np.random.default_rng(0)
+        sample = rows[rng.choice(len(rows), size=min(len(rows), nlist * 64), replace=False)]
+        centroids = np.array(matrix[rng.choice(sample, size=nlist, replace=False)])
+        for _ in range(10):
+            assign = np.argmax(np.asarray(matrix[sample]) @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assign == c]
+                if len(members):
+                    centroids[c] = np.asarray(matrix[members]).mean(axis=0)
+            centroids = self._normalize(centroids)
+        return centroids
+
+    @staticmethod
+    def _assign_ivf(matrix, rows, centroids):
+        """Nearest centroid of each row, as int32."""
+        assign = np.empty(len(rows), dtype=np.int32)
+        for start in range(0, len(rows), 65536):
+            block = rows[start:start + 65536]
+            assign[start:start + len(block)] = np.argmax(np.asarray(matrix[block]) @ centroids.T, axis=1)
+        return assign
+
+    def _load_ivf(self):
+        """(centroids, inverted lists of row indices) as written by _update_ivf()."""
+        if self._ivf is None:
+            meta = self._load_meta()
+            centroids_path, lists_path = self._ivf_files(meta["generation"])
+            centroids = np.load(centroids_path)
+            assign = np.fromfile(lists_path, dtype=np.int32, count=meta["ivf_rows"])
+            order = np.argsort(assign, kind="stable")
+            bounds = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+            self._ivf = centroids, [order[bounds[c]:bounds[c + 1]] for c in range(len(centroids))]
+        return self._ivf
+
+    def query(self, query_embedding, n_results=5, doc_ids=None):
+        with self._lock:
+            meta = self._load_meta()
+            matrix = self._matrix()
+            if matrix is None:
+                return [], []
+            live = np.array(meta["live"], dtype=bool)
+            q = self._normalize(query_embedding)
+
+            if live.sum() >= IVF_MIN_VECTORS and meta["ivf_rows"]:
+                centroids, lists = self._load_ivf()
+                probes = np.argsort(-(centroids @ q))[:IVF_NPROBE]
+                # Lists keep tombstoned rows until the next compaction
+                candidates = np.concatenate([lists[c] for c in probes])
+                candidates = candidates[live[candidates]]
+            else:
+                candidates = np.flatnonzero(live)
+            if doc_ids:
+                # Exact scan of the selected documents: probing a few IVF lists could miss a small document
+                candidates = np.flatnonzero(live & np.isin(np.array(meta["docs"]), list(doc_ids)))
+            if len(candidates) == 0:
+                return [], []
+
+            scores = np.asarray(matrix[candidates]) @ q
+            k = min(n_results, len(candidates))
+            top = np.argpartition(-scores, k - 1)[:k]
+            rows = candidates[top[np.argsort(-scores[top])]]
+            texts = self._load_texts()
+            return [texts[r] for r in rows], [meta["ids"][r] for r in rows]
+
+
+_store = None
+_store_version = None
+_store_lock = threading.Lock()
+
+
+def get_vector_store(collection_version=None):
+    """The process-wide vector store.
+
+    Readers pass the current collection version (db.get_collection_version()): when it changed,
+    another process (the ingestion worker) has written to the store since it was opened here,
+    so it is reopened before use. Writes need no version: the numpy store reloads its index under
+    a file lock before each write, and Chroma commits every write to its SQLite database.
+    """
+    global _store, _store_version
+    with _store_lock:
+        if _store is None:
+            _store = NumpyVectorStore() if VECTOR_BACKEND == "numpy" else ChromaVectorStore()
+        if collection_version is not None and collection_version != _store_version:
+            _store.reopen()
+            _store_version = collection_version
+        return _store
@@ -0,0 +1,139 @@
+"""Deterministic offline stand-in for the OpenAI embeddings and chat APIs: python -m app.stub_openai
+
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:8765/v1 (any OPENAI_API_KEY works).
+Embeddings are normalized hashed bag-of-words vectors, so texts that share words are close;
+chat answers cite the first sources listed in the prompt. Used by app.benchmark.
+"""
+import os
+import re
+import json
+import math
+import time
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+STUB_EMBEDDING_DIM = int(os.getenv("STUB_EMBEDDING_DIM", 384))
+# Simulated per-request network/model latency
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", 0))
+
+
+def stub_embedding(text, dim=STUB_EMBEDDING_DIM):
+    vector = [0.0] * dim
+    words = re.findall(r"\w+", text.lower())
+    for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        bucket = int.from_bytes(digest[:4], "little") % dim
+        vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+def stub_answer(messages):
+    prompt = "\n".join(m.get("content") or "" for m in messages)
+    sources = list(dict.fromkeys(re.findall(r"\[Source ([^\]#]+)\]", prompt)))[:2]
+    if not sources:
+        return "The provided sources do not contain enough information."
+    return "According to the documents, " + " and ".join(f"see [Source {source}]" for source in sources) + "."
+
+
+def count_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Keep-alive without Nagle, so the stub adds no ~40ms delayed-ACK stalls to measured latencies
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if STUB_LATENCY_MS:
+            time.sleep(STUB_LATENCY_MS / 1000)
+        if self.path.endswith("/embeddings"):
+            self.embeddings(request)
+        elif self.path.endswith("/chat/completions"):
+            self.chat(request)
+        else:
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def embeddings(self, request):
+        inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        tokens = sum(count_tokens(str(text)) for text in inputs)
+        self.send_json({
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": stub_embedding(str(text))}
+                     for i, text in enumerate(inputs)],
+            "model": request.get("model", "stub"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    @staticmethod
+    def usage(request, answer):
+        prompt_tokens = sum(count_tokens(m.get("content") or "") for m in request.get("messages", []))
+        completion_tokens = count_tokens(answer)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    def chat(self, request):
+        answer = stub_answer(request.get("messages", []))
+        created = int(time.time())
+        base = {"id": "chatcmpl-stub", "created": created, "model": request.get("model", "stub")}
+        if not request.get("stream"):
+            self.send_json({
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": self.usage(request, answer),
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for word in re.findall(r"\S+\s*", answer):
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        done = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        self.wfile.write(f"data: {json.dumps(done)}\n\n".encode())
+        if (request.get("stream_options") or {}).get("include_usage"):
+            usage = {**base, "object": "chat.completion.chunk", "choices": [], "usage": self.usage(request, answer)}
+            self.wfile.write(f"data: {json.dumps(usage)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_stub_server(host="127.0.0.1", port=0):
+    """Serve in a daemon thread; returns (server, base_url). port=0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), StubOpenAIHandler)
+    threading.Thread(target=server.serve_forever, name="stub-openai", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline stub of the OpenAI embeddings and chat APIs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), StubOpenAIHandler)
+    print(f"🧪 Stub OpenAI API on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,33 @@
-import time
-import ast
+import io
+import os
 import requests
 import pandas as pd
 import streamlit as st
 from PIL import ImageDraw
-from surya.settings import settings
-import fitz  # PyMuPDF
 
-from app.helpers.layout_analysis import get_page_image, draw_polys_on_image
-from app.helpers.db import select_layout_analysis
-from app.helpers.openaiApi import retrieve_and_generate
-
-API_URL = "http://127.0.0.1:8000/ask/rag_response"
+from app.helpers.layout_analysis import IMAGE_DPI_HIGHRES, get_page_image, draw_polys_on_image
+from app.helpers.db import select_chunk_polys, select_documents
+from app.helpers.documents import document_id, parse_source_key, citation_label
+from app.helpers.page_cache import page_cache
+from app.helpers.openaiApi import retrieve_and_generate_stream
+from app.helpers.jobs import active_jobs, ensure_worker
+
+# With USE_RAG_API=1 the tabs are thin clients of the FastAPI service (api.py)
+USE_RAG_API = os.getenv("USE_RAG_API", "0") == "1"
+API_BASE_URL = os.getenv("RAG_API_URL", "http://127.0.0.1:8000")
+API_URL = f"{API_BASE_URL}/ask/rag_response"
 DATABASE = "application.db"
 HIGHLIGHT_COLOR = (225, 225, 0)
+THUMBNAIL_WIDTH = 600
+THUMBNAIL_QUALITY = 80
 
 
 # --- Utility Functions ---
 
-def process_page_chunks(data, real_page_number):
-    page_label = f"page_{real_page_number}"
-    matching_key = next((k for k, v in data["Pages"].items() if v == page_label), None)
+def process_page_chunks(data, source):
+    matching_key = next((k for k, v in data["Pages"].items() if v == source), None)
     if matching_key is None:
-        raise ValueError(f"Page {real_page_number} not found in data['Pages'].")
+        raise ValueError(f"Source {source} not found in data['Pages'].")
 
     chunks = data["Chunks"].get(matching_key, [])
     all_lines = []
@@ -38,44 +43,73 @@ def process_page_chunks(data, real_page_number):
 
 
 def highlight_text_on_image(image, pdf_file, page_num, texts_to_highlight, dpi=300):
-    pdf_bytes = pdf_file.getvalue()
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    page = doc[page_num - 1]
     draw = ImageDraw.Draw(image, "RGBA")
     scale = dpi / 72
 
     if isinstance(texts_to_highlight, str):
         texts_to_highlight = [texts_to_highlight]
 
-    for text in texts_to_highlight:
-        for rect in page.search_for(text):
-            x0, y0, x1, y1 = [int(coord * scale) for coord in rect]
-            draw.rectangle([x0, y0, x1, y1], fill=HIGHLIGHT_COLOR + (128,))
-    doc.close()
+    for rect in page_cache.search_text(pdf_file, page_num, texts_to_highlight):
+        x0, y0, x1, y1 = [int(coord * scale) for coord in rect]
+        draw.rectangle([x0, y0, x1, y1], fill=HIGHLIGHT_COLOR + (128,))
     return image
 
 
-def find_polys(page, ai_chunks):
-    page_id = f"page_{page}"
+def find_polys(source, ai_chunks):
     if isinstance(ai_chunks, dict):
         ai_chunks = pd.DataFrame(ai_chunks)
-    filtered_df = ai_chunks.query("Pages == @page_id")
-    layout_df = select_layout_analysis(page_id)
+    filtered_df = ai_chunks.query("Pages == @source")
 
-    polys, texts = [], []
+    texts, chunk_ids = [], []
     for _, chunk_row in filtered_df.iterrows():
         texts.append(chunk_row['Chunks'][0])
-        for i, layout_row in layout_df.iterrows():
-            if layout_row['text'] in chunk_row['Chunks'][0] or chunk_row['Chunks'][0] in layout_row['text']:
-                polys.append(layout_row['poly'])
-                if i > 0:
-                    polys.append(layout_df.iloc[i - 1]['poly'])
-                if i < len(layout_df) - 1:
-                    polys.append(layout_df.iloc[i + 1]['poly'])
-    return texts, [ast.literal_eval(p) for p in polys]
+        chunk_ids.extend(chunk_row['Ids'])
+    return texts, select_chunk_polys(chunk_ids)
+
+
+def source_pdf(in_files, doc_id):
+    """The uploaded file of a document, or the copy stored when it was ingested."""
+    if doc_id in in_files:
+        return in_files[doc_id]
+    stored = next((doc for doc in select_documents() if doc["doc_id"] == doc_id), None)
+    if stored is None or not os.path.exists(stored["pdf_path"]):
+        raise FileNotFoundError(f"No PDF available for document {doc_id}")
+    with open(stored["pdf_path"], "rb") as f:
+        in_files[doc_id] = f.read()
+    return in_files[doc_id]
+
+
+def annotate_source_page(in_files, source, ai_chunks, dpi=IMAGE_DPI_HIGHRES):
+    """Render a source page ("report/page_3") with the answer's chunks highlighted and their layout blocks outlined."""
+    doc_id, page = parse_source_key(source)
+    in_file = source_pdf(in_files, doc_id)
+    _, polygons = find_polys(source, ai_chunks)
+    base_img = get_page_image(in_file, page, dpi=dpi)
+    search_texts = process_page_chunks(ai_chunks, source)
+    highlighted_img = highlight_text_on_image(base_img.copy(), in_file, page, search_texts, dpi=dpi)
+    return draw_polys_on_image(polygons, highlighted_img, label_font_size=30)
+
+
+def encode_image(image, max_width=None, quality=THUMBNAIL_QUALITY):
+    if max_width and image.width > max_width:
+        image = image.resize((max_width, round(image.height * max_width / image.width)))
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def build_source_thumbnails(in_files, pages, ai_chunks):
+    """Annotated source pages for one answer, as compressed JPEG thumbnails stored with the message."""
+    return [encode_image(annotate_source_page(in_files, page, ai_chunks), THUMBNAIL_WIDTH) for page in pages]
 
 
-def render_sources(images, page_numbers):
+def render_sources(message, in_files, message_index):
+    """Show an answer's cached thumbnails; full-resolution pages are rendered only when asked for."""
+    if "thumbnails" not in message:
+        message["thumbnails"] = build_source_thumbnails(in_files, message["source_pages"], message["ai_chunks"])
+    full_images = message.setdefault("full_images", {})
+    images, page_numbers = message["thumbnails"], message["source_pages"]
+
     images_per_row = 3
     with st.expander("Related Pages"):
         for i in range(0, len(images), images_per_row):
@@ -83,81 +117,94 @@ def render_sources(images, page_numbers):
             num_cols = min(images_per_row, remaining)
             cols = st.columns(num_cols)
             for j in range(num_cols):
+                page = page_numbers[i + j]
                 with cols[j]:
                     st.image(images[i + j],use_column_width=True)
                     st.markdown(
                         f"""<div style="background-color: yellow; color: black; text-align: center; padding: 5px; border-radius: 5px;margin-bottom:10px;">
-                            Page {page_numbers[i + j]}
+                            {citation_label(page)}
                         </div>""",
                         unsafe_allow_html=True
                     )
+                    if st.checkbox("Full resolution", key=f"full_res_{message_index}_{page}"):
+                        if page not in full_images:
+                            full_images[page] = encode_image(
+                                annotate_source_page(in_files, page, message["ai_chunks"]), quality=90
+                            )
+                        st.image(full_images[page], use_column_width=True)
+
+def ask_rag_api(question, doc_ids=None):
+    response = requests.post(API_URL, json={"question": question, "doc_ids": doc_ids}, timeout=120)
+    response.raise_for_status()
+    payload = response.json()
+    return payload["answer"], payload["pages"], pd.DataFrame(payload["ai_chunks"])
+
+
+def answer_stream(question, doc_ids=None):
+    if USE_RAG_API:
+        result = ask_rag_api(question, doc_ids)
+        yield result[0]
+        yield result
+    else:
+        yield from retrieve_and_generate_stream(question, doc_ids)
+
+
+def select_document_filter(in_files):
+    """Documents to search: every ingested document unless the user narrows it down."""
+    doc_ids = list(dict.fromkeys([doc["doc_id"] for doc in select_documents()] + list(in_files)))
+    if len(doc_ids) < 2:
+        return None
+    selected = st.multiselect("Search in documents", doc_ids, default=doc_ids, key="document_filter")
+    return None if len(selected) in (0, len(doc_ids)) else selected
+
 
 # --- Main Chat UI Function ---
-def chatbot_interface(in_file):
-    
+def chatbot_interface(pdf_files):
+    in_files = {document_id(getattr(f, "name", None)): f for f in pdf_files}
+    doc_ids = select_document_filter(in_files)
 
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = []
 
     # --- Show Chat History with Highlighted Pages ---
-    for message in st.session_state.chat_history:
+    for message_index, message in enumerate(st.session_state.chat_history):
         with st.chat_message(message["role"]):
             st.markdown(message["message"], unsafe_allow_html=True)
 
-            if message["role"] == "assistant" and "source_pages" in message and "ai_chunks" in message:
-                pages = message["source_pages"]
-                ai_chunks = message["ai_chunks"]
-
-                if pages:
-                    images, page_text_map = [], {}
-                    for page in pages:
-                        text_chunks, polygons = find_polys(page, ai_chunks)
-                        base_img = get_page_image(in_file, page, dpi=settings.IMAGE_DPI_HIGHRES)
-                        search_texts = process_page_chunks(ai_chunks, page)
-                        highlighted_img = highlight_text_on_image(
-                            base_img.copy(), in_file, page, search_texts, dpi=settings.IMAGE_DPI_HIGHRES
-                        )
-                        final_img = draw_polys_on_image(polygons, highlighted_img, label_font_size=30)
-                        images.append(final_img)
-                        page_text_map[page] = text_chunks
-                    render_sources(images,pages)
+            if message["role"] == "assistant" and message.get("source_pages") and "ai_chunks" in message:
+                render_sources(message, in_files, message_index)
 
     # --- Handle New User Input ---
-    if user_input := st.chat_input("Ask a question about this PDF..."):
+    if user_input := st.chat_input("Ask a question about these PDFs..."):
         st.session_state.chat_history.append({"role": "user", "message": user_input})
         with st.chat_message("user"):
             st.markdown(user_input)
 
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                answer,pages,ai_chunks = retrieve_and_generate(user_input)
             buffer = ""
             display = st.empty()
-            for word in answer.split():
-                buffer += " " + word
-                time.sleep(0.04)
-                display.markdown(buffer + " ▌", unsafe_allow_html=True)
+            display.markdown("▌")
+            for item in answer_stream(user_input, doc_ids):
+                if isinstance(item, str):
+                    buffer += item
+                    display.markdown(buffer.replace("_", " ") + " ▌", unsafe_allow_html=True)
+                else:
+                    answer, pages, ai_chunks = item
             display.markdown(answer, unsafe_allow_html=True)
 
-            # Show visual context
-            if pages:
-                images, page_text_map = [], {}
-                for page in pages:
-                    text_chunks, polygons = find_polys(page, ai_chunks)
-                    base_img = get_page_image(in_file, page, dpi=settings.IMAGE_DPI_HIGHRES)
-                    search_texts = process_page_chunks(ai_chunks, page)
-                    highlighted_img = highlight_text_on_image(
-                        base_img.copy(), in_file, page, search_texts, dpi=settings.IMAGE_DPI_HIGHRES
-                    )
-                    final_img = draw_polys_on_image(polygons, highlighted_img, label_font_size=30)
-                    images.append(final_img)
-                    page_text_map[page] = text_chunks
-                render_sources(images,pages)
-
             # Store assistant response + metadata
-            st.session_state.chat_history.append({
+            message = {
                 "role": "assistant",
                 "message": answer,
                 "source_pages": pages,
                 "ai_chunks": ai_chunks,
-            })
+            }
+            st.session_state.chat_history.append(message)
+
+            # Cited pages with deferred regions were queued for reading; make sure a worker picks them up
+            if pages and not USE_RAG_API and any(job["kind"] == "deferred" for job in active_jobs()):
+                ensure_worker()
+
+            # Show visual context (annotated once, replayed from the message afterwards)
+            if pages:
+                render_sources(message, in_files, len(st.session_state.chat_history) - 1)
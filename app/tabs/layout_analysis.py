@@ -1,61 +1,120 @@
 
-from app.helpers.layout_analysis import *
 import time
-from app.helpers.embeddings import *
-
-DATABASE = 'application.db'
-
-
-
-def reset_table_layout_analyis():
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        c.execute("DROP TABLE IF EXISTS layout_analysis")
-        conn.commit()
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS layout_analysis (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                text TEXT,
-                label TEXT,
-                page TEXT,
-                poly TEXT
-            )''')
-        conn.commit()
-    print("table was reset successfully")
-
-predictors = load_predictors_cached()
-
-def layout_analysis(page_count, pdf_file):
-    empty_directory('./data/', skip_dirs=["chroma_persistent_storage"])
-    save_path = os.path.join("data", "uploaded.pdf")
-    os.makedirs("data", exist_ok=True)
-
-    with st.spinner("Saving PDF and resetting layout analysis table..."):
-        with open(save_path, "wb") as f:
-            f.write(pdf_file.getbuffer())
-        reset_table_layout_analyis()
-    
-    for i in range(page_count):
-        with st.spinner(f"Layout analysis on page {i+1} out of {page_count}..."):
-            pil_image_highres = get_page_image(pdf_file, i + 1, dpi=settings.IMAGE_DPI_HIGHRES)
-            _, _ = layout_detection(pil_image_highres, i + 1)
-    with st.spinner("Generating embeddings..."):
-        chunked_documents = generate_embeddings()
-        
-    with st.spinner("Inserting embeddings to vector db..."):
-        insert_embeddings_into_vector_db(chunked_documents)  
-
-def layout_analysis_interface(pdf_file):
-    page_count = page_counter(pdf_file)
-    pages = []
-    for i in range(page_count):
-        pages.append(("page_"+str(i+1)))
-    if st.button("Analyze PDF", key="analyze_pdf_button"):
-        layout_analysis(page_count, pdf_file)
-        placeholder = st.empty()
-        placeholder.success("Layout analysis complete.")
-        time.sleep(2)
-        placeholder.empty()
-        return True
-        
\ No newline at end of file
+import requests
+import streamlit as st
+from app.helpers.jobs import enqueue_job, enqueue_document_job, get_job, cancel_job, active_jobs, ensure_worker
+from app.helpers.documents import document_id
+from app.tabs.chatbot import USE_RAG_API, API_BASE_URL
+
+# Ingestion runs in the worker process (app.worker): this tab never loads the layout models
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+def render_progress(progress_bar, progress, doc_id=None):
+    done = progress["upsert"] + progress["skipped"]
+    eta = progress.get("eta_seconds")
+    progress_bar.progress(
+        done / max(progress["total"], 1),
+        text=(f"{doc_id}: " if doc_id else "") + f"Rendered {progress['render']}, layout {progress['layout']}, OCR {progress['ocr']}, "
+             f"embedded {progress['embed']}, queryable {progress['upsert']} "
+             f"({progress['skipped']} unchanged) of {progress['total']} pages"
+             + (f" — about {int(eta // 60)}m {int(eta % 60)}s left" if eta is not None else ""),
+    )
+
+# --- Ingest jobs (run by app.worker, or by the API service when USE_RAG_API=1) ---
+def submit_ingest_job(pdf_file, incremental):
+    filename = getattr(pdf_file, "name", "uploaded.pdf")
+    if USE_RAG_API:
+        response = requests.post(
+            f"{API_BASE_URL}/ingest",
+            params={"incremental": incremental},
+            files={"file": (filename, pdf_file.getvalue(), "application/pdf")},
+            timeout=120,
+        )
+        response.raise_for_status()
+        return response.json()["id"]
+    job_id = enqueue_job(pdf_file.getvalue(), filename, incremental)
+    ensure_worker()
+    return job_id
+
+def fetch_job(job_id):
+    if USE_RAG_API:
+        return requests.get(f"{API_BASE_URL}/jobs/{job_id}", timeout=30).json()
+    return get_job(job_id)
+
+def request_cancel(job_id):
+    if USE_RAG_API:
+        requests.post(f"{API_BASE_URL}/jobs/{job_id}/cancel", timeout=30)
+    else:
+        cancel_job(job_id)
+
+def submit_deferred_job(doc_id):
+    """Queue an OCR of the regions the region policy deferred (tables by default); the worker re-indexes their pages."""
+    if USE_RAG_API:
+        response = requests.post(f"{API_BASE_URL}/documents/{doc_id}/deferred", timeout=30)
+        response.raise_for_status()
+        return response.json()["id"]
+    job_id = enqueue_document_job(doc_id, "deferred")
+    ensure_worker()
+    return job_id
+
+def watch_jobs(job_ids):
+    """Poll jobs until all have finished, one progress bar each. Jobs keep running if this page is closed or rerun."""
+    progress_bars = {job_id: st.progress(0.0, text="Waiting for the ingest worker...") for job_id in job_ids}
+    jobs = {}
+    while True:
+        for job_id, progress_bar in progress_bars.items():
+            if job_id in jobs and jobs[job_id]["status"] in FINISHED_STATUSES:
+                continue
+            jobs[job_id] = fetch_job(job_id)
+            # Deferred-region jobs report no per-stage progress
+            if "total" in jobs[job_id]["progress"]:
+                render_progress(progress_bar, jobs[job_id]["progress"], jobs[job_id].get("doc_id"))
+        if all(job["status"] in FINISHED_STATUSES for job in jobs.values()):
+            return [jobs[job_id] for job_id in job_ids]
+        time.sleep(1)
+
+def layout_analysis(pdf_files, incremental=True):
+    return watch_jobs([submit_ingest_job(pdf_file, incremental) for pdf_file in pdf_files])
+
+def layout_analysis_interface(pdf_files):
+    st.caption("Documents: " + ", ".join(document_id(f.name) for f in pdf_files))
+    incremental = st.checkbox("Only re-analyze changed pages", value=True, key="incremental_ingest")
+    if st.button("Analyze PDFs", key="analyze_pdf_button"):
+        # One job per document: unchanged documents are skipped page by page and the rest run in parallel
+        st.session_state.ingest_job_ids = [submit_ingest_job(pdf_file, incremental) for pdf_file in pdf_files]
+    if st.button("Read deferred regions", key="deferred_regions_button",
+                 help="OCR the regions skipped at ingestion by the region policy (tables by default) and index them"):
+        with st.spinner("Reading deferred regions..."):
+            jobs = watch_jobs([submit_deferred_job(document_id(pdf_file.name)) for pdf_file in pdf_files])
+        for job in jobs:
+            if job["status"] == "done":
+                st.info(f"{job['doc_id']}: read {job['progress']['regions']} deferred regions.")
+            else:
+                st.error(f"{job['doc_id']}: reading deferred regions {job['status']}: {job['error']}")
+
+    job_ids = st.session_state.get("ingest_job_ids")
+    if not job_ids and not USE_RAG_API:
+        # Reattach to jobs started before a disconnect or restart
+        job_ids = [job["id"] for job in active_jobs() if job["kind"] == "ingest"]
+    if not job_ids:
+        return False
+
+    if st.button("Cancel ingestion", key="cancel_ingest_button"):
+        for job_id in job_ids:
+            request_cancel(job_id)
+    jobs = watch_jobs(job_ids)
+    st.session_state.ingest_job_ids = None
+    placeholder = st.empty()
+    with placeholder.container():
+        for job in jobs:
+            name = job.get("doc_id") or job["filename"]
+            if job["status"] == "done":
+                st.success(f"{name}: layout analysis complete.")
+            elif job["status"] == "cancelled":
+                st.warning(f"{name}: layout analysis cancelled. Finished pages are kept; analyzing again resumes from there.")
+            else:
+                st.error(f"{name}: layout analysis failed: {job['error']}")
+    time.sleep(2)
+    placeholder.empty()
+    return all(job["status"] == "done" for job in jobs)
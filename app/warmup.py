@@ -0,0 +1,64 @@
+"""Preload what is otherwise loaded on first use: python -m app.warmup [--layout] [--ocr] [--query]
+
+Nothing heavy is loaded at import time: the Surya predictors on the first layout batch, the OCR
+process pool on the first OCR batch, and the OpenAI client and vector store on the first question.
+Warming up moves that cost out of the first request. With no flags everything is preloaded.
+"""
+import time
+import argparse
+
+from PIL import Image
+
+# US Letter, in inches
+WARMUP_PAGE_INCHES = (8.5, 11)
+
+
+def warm_layout():
+    """Load the Surya predictors and run one layout prediction (first inference initializes kernels)."""
+    from app.helpers.layout_analysis import predict_layout, IMAGE_DPI_HIGHRES
+    # A blank page at the DPI the ingest pipeline renders pages for layout
+    size = tuple(round(inches * IMAGE_DPI_HIGHRES) for inches in WARMUP_PAGE_INCHES)
+    predict_layout([Image.new("RGB", size, "white")])
+
+
+def warm_ocr():
+    """Spawn the OCR worker processes and load an OCR engine in each by OCR'ing a blank region."""
+    from app.helpers.ocr import OCR_WORKERS, ocr_regions
+    ocr_regions([(Image.new("RGB", (200, 50), "white"), "Text-0-1.0")] * max(1, OCR_WORKERS))
+
+
+def warm_query():
+    """Create the OpenAI clients, open the vector store and the FTS5 index. Makes no API calls."""
+    from app.helpers.openaiApi import get_client, get_async_client
+    from app.helpers.vector_store import get_vector_store
+    from app.helpers.lexical_index import lexical_search
+    get_client()
+    get_async_client()
+    get_vector_store().count()
+    lexical_search("warmup", n_results=1)
+
+
+WARMUPS = {"layout": warm_layout, "ocr": warm_ocr, "query": warm_query}
+
+
+def warmup(components=None):
+    """Run the given warm-ups (default all); returns seconds per component."""
+    seconds = {}
+    for name in components or WARMUPS:
+        t0 = time.perf_counter()
+        WARMUPS[name]()
+        seconds[name] = time.perf_counter() - t0
+        print(f"🔥 Warmed up {name} in {seconds[name]:.1f}s")
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preload models, worker pools and clients.")
+    for name, fn in WARMUPS.items():
+        parser.add_argument(f"--{name}", action="store_true", help=fn.__doc__)
+    args = parser.parse_args()
+    warmup([name for name in WARMUPS if getattr(args, name)])
+
+
+if __name__ == "__main__":
+    main()
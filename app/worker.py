@@ -0,0 +1,137 @@
+"""Background ingestion worker: python -m app.worker [--once]
+
+Claims queued jobs from the ingest_jobs table and runs up to INGEST_CONCURRENCY of them (one
+per document): ingestion through the streaming pipeline, writing per-stage progress and ETA back
+to the table, reads of deferred regions and document deletes. It is the only process that writes the indexes.
+"""
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from app.helpers.documents import document_id
+from app.helpers.metrics import metrics, start_metrics_server
+from app.helpers.ocr import ocr_backend, shutdown_ocr_pools
+from app.helpers.jobs import (
+    WORKER_PID_FILE, acquire_worker_lock, worker_pid, claim_next_job, update_job_progress, finish_job, is_cancel_requested,
+    requeue_orphaned_jobs, init_jobs_table, with_eta,
+)
+
+POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", 2))
+PROGRESS_INTERVAL = 1.0
+# Documents ingested at the same time; they share the layout model, the OCR pool and the embedding client
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", 2))
+# Serve this worker's ingestion metrics at http://127.0.0.1:<port>/metrics (off when unset)
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+
+def run_ingest(job, started_at):
+    from app.helpers.ingest import ingest_document
+
+    last = {"progress": 0.0, "cancel_check": 0.0}
+
+    def on_progress(progress):
+        if time.time() - last["progress"] >= PROGRESS_INTERVAL:
+            update_job_progress(job["id"], with_eta(progress, started_at))
+            last["progress"] = time.time()
+
+    def should_stop():
+        if time.time() - last["cancel_check"] < PROGRESS_INTERVAL:
+            return False
+        last["cancel_check"] = time.time()
+        return is_cancel_requested(job["id"])
+
+    # A retried job resumes: pages finished by the previous attempt are skipped by fingerprint
+    resume = job["attempts"] > 1
+    with open(job["pdf_path"], "rb") as f:
+        pdf_bytes = f.read()
+    result = ingest_document(pdf_bytes, job["incremental"] or resume,
+                             on_progress=on_progress, should_stop=should_stop,
+                             doc_id=job["doc_id"] or document_id(job["filename"]), filename=job["filename"])
+    return with_eta(result, started_at)
+
+
+def run_deferred(job):
+    from app.helpers.layout_analysis import ocr_deferred_regions
+    return {"regions": ocr_deferred_regions(job["doc_id"], job["pages"])}
+
+
+def run_delete(job):
+    from app.helpers.ingest import remove_document
+    remove_document(job["doc_id"])
+    return {"deleted": True}
+
+
+def run_job(job):
+    from app.helpers.pipeline import PipelineCancelled
+
+    started_at = time.time()
+    resume = job["kind"] == "ingest" and job["attempts"] > 1
+    print(f"🛠️ Job {job['id']} ({job['kind']} {job['filename']}) attempt {job['attempts']}"
+          f"{' (resuming)' if resume else ''}")
+    try:
+        if job["kind"] == "deferred":
+            result = run_deferred(job)
+        elif job["kind"] == "delete":
+            result = run_delete(job)
+        else:
+            result = run_ingest(job, started_at)
+        finish_job(job["id"], "done", progress=result)
+        metrics.increment("jobs.finished", status="done")
+    except PipelineCancelled as e:
+        print(f"🛑 {e}")
+        finish_job(job["id"], "cancelled")
+        metrics.increment("jobs.finished", status="cancelled")
+    except Exception as e:
+        print(f"❌ Job {job['id']} failed: {e}")
+        finish_job(job["id"], "failed", error=str(e))
+        metrics.increment("jobs.finished", status="failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run queued ingestion jobs.")
+    parser.add_argument("--once", action="store_true", help="exit when the queue is empty")
+    parser.add_argument("--warmup", action="store_true",
+                        help="load the layout models and OCR pool before polling instead of on the first job")
+    args = parser.parse_args()
+
+    # Released by the OS when this process exits, however it exits
+    lock_file = acquire_worker_lock()
+    if lock_file is None:
+        print(f"⏭️ Another ingest worker (pid {worker_pid()}) is already running")
+        return
+    init_jobs_table()
+    with open(WORKER_PID_FILE, "w") as f:
+        f.write(str(os.getpid()))
+    requeued = requeue_orphaned_jobs()
+    if requeued:
+        print(f"♻️ Requeued {requeued} interrupted jobs")
+    print(f"🔠 OCR backend: {ocr_backend()}")
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+        print(f"📈 Worker metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+    if args.warmup:
+        from app.warmup import warmup
+        warmup(["layout", "ocr"])
+
+    running = set()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, INGEST_CONCURRENCY), thread_name_prefix="job") as pool:
+            while True:
+                running = {future for future in running if not future.done()}
+                job = claim_next_job(os.getpid()) if len(running) < INGEST_CONCURRENCY else None
+                if job is not None:
+                    running.add(pool.submit(run_job, job))
+                    continue
+                if args.once and not running:
+                    return
+                time.sleep(POLL_INTERVAL if not running else min(POLL_INTERVAL, 0.5))
+    finally:
+        shutdown_ocr_pools()
+        if worker_pid() == os.getpid():
+            os.remove(WORKER_PID_FILE)
+        lock_file.close()
+
+
+if __name__ == "__main__":
+    main()